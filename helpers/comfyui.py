@@ -1,6 +1,6 @@
 import os
 import urllib.request
-import subprocess
+import urllib.parse
 import threading
 import time
 import json
@@ -10,8 +10,23 @@ import json
 import os
 import websocket
 import random
+import queue
+from contextlib import nullcontext
 from weights_downloader import WeightsDownloader
-from urllib.error import URLError
+from helpers.http_client import HTTPClient
+from helpers.comfyui_supervisor import ComfyUISupervisor
+from helpers.comfyui_common import (
+    PromptRouter,
+    QUEUE_PROMPT_ERROR,
+    url_inputs,
+    saved_images,
+    local_output,
+    view_params,
+)
+
+# Seconds of websocket silence before we ping, a connection that stays
+# silent for three of these is reconnected
+WEBSOCKET_HEARTBEAT = 15
 
 
 # custom_nodes helpers
@@ -22,42 +37,43 @@ from helpers.ComfyUI_BRIA_AI_RMBG import ComfyUI_BRIA_AI_RMBG
 
 
 class ComfyUI:
-    def __init__(self, server_address):
-        self.weights_downloader = WeightsDownloader()
+    def __init__(self, server_address, weights_downloader=None):
+        self.weights_downloader = weights_downloader or WeightsDownloader()
         self.server_address = server_address
+        self.http = HTTPClient(server_address)
+        self.output_directory = None
+        # One websocket per client, shared by every in-flight prompt. Messages
+        # are routed to per-prompt waiters by prompt_id.
+        self.client_id = str(uuid.uuid4())
+        self.ws = None
+        self.ws_lock = threading.Lock()
+        self.ws_thread = None
+        self.ws_connected = threading.Event()
+        # When the websocket went down, None while it is up
+        self.ws_down_since = None
+        self.router = PromptRouter(queue.Queue, lambda waiter, item: waiter.put(item))
+        self.supervisor = None
         ComfyUI_IPAdapter_plus.prepare()
 
-    def start_server(self, output_directory, input_directory):
+    def start_server(self, output_directory, input_directory, on_startup=None):
         self.input_directory = input_directory
         self.output_directory = output_directory
 
         self.download_pre_start_models()
 
-        server_thread = threading.Thread(
-            target=self.run_server, args=(output_directory, input_directory)
+        self.supervisor = ComfyUISupervisor(
+            [self], output_directory, input_directory, on_startup
         )
-        server_thread.start()
-
-        start_time = time.time()
-        while not self.is_server_running():
-            if time.time() - start_time > 60:  # If more than a minute has passed
-                raise TimeoutError("Server did not start within 60 seconds")
-            time.sleep(1)  # Wait for 1 second before checking again
+        if self.supervisor.start():
+            raise TimeoutError("Server did not start within 60 seconds")
 
         print("Server running")
 
-    def run_server(self, output_directory, input_directory):
-        command = f"python ./ComfyUI/main.py --output-directory {output_directory} --input-directory {input_directory} --disable-metadata --preview-method none --gpu-only"
-        server_process = subprocess.Popen(command, shell=True)
-        server_process.wait()
-
     def is_server_running(self):
         try:
-            with urllib.request.urlopen(
-                "http://{}/history/{}".format(self.server_address, "123")
-            ) as response:
-                return response.status == 200
-        except URLError:
+            status, _ = self.http.request("GET", "/history/123", retries=0)
+            return status == 200
+        except OSError:
             return False
 
     def download_pre_start_models(self):
@@ -66,6 +82,15 @@ class ComfyUI:
 
     def handle_weights(self, workflow):
         print("Checking weights")
+        # Handler extras like antelopev2 and the preprocessor checkpoints are
+        # resolved here too, then everything is fetched at once
+        weights = self.weights_to_download(workflow)
+        print(f"Resolved weights: {sorted(weights)}")
+        self.weights_downloader.download_all(weights)
+        print("====================================")
+
+    @staticmethod
+    def weights_to_download(workflow):
         weights_to_download = []
         weights_filetypes = [
             ".ckpt",
@@ -92,109 +117,209 @@ class ComfyUI:
                         if any(input.endswith(ft) for ft in weights_filetypes):
                             weights_to_download.append(input)
 
-        weights_to_download = list(set(weights_to_download))
-
-        for weight in weights_to_download:
-            self.weights_downloader.download_weights(weight)
-            print(f"✅ {weight}")
-
-        print("====================================")
-
-    def is_image_or_video_value(self, value):
-        filetypes = [".png", ".jpg", ".jpeg", ".webp", ".mp4", ".webm"]
-        return isinstance(value, str) and any(
-            value.lower().endswith(ft) for ft in filetypes
-        )
+        return list(set(weights_to_download))
 
     def handle_inputs(self, workflow):
         print("Checking inputs")
-        seen_inputs = set()
-        for node in workflow.values():
-            if "inputs" in node:
-                for input_key, input_value in node["inputs"].items():
-                    if isinstance(input_value, str) and input_value not in seen_inputs:
-                        seen_inputs.add(input_value)
-                        if input_value.startswith(("http://", "https://")):
-                            filename = os.path.join(
-                                self.input_directory, os.path.basename(input_value)
-                            )
-                            if not os.path.exists(filename):
-                                print(f"Downloading {input_value} to {filename}")
-                                urllib.request.urlretrieve(input_value, filename)
-                            node["inputs"][input_key] = filename
-                            print(f"✅ {filename}")
-                        elif self.is_image_or_video_value(input_value):
-                            filename = os.path.join(
-                                self.input_directory, os.path.basename(input_value)
-                            )
-                            if not os.path.exists(filename):
-                                print(f"❌ {filename} not provided")
-                            else:
-                                print(f"✅ {filename}")
+        for inputs, input_key, url, filename in url_inputs(
+            workflow, self.input_directory
+        ):
+            if not os.path.exists(filename):
+                print(f"Downloading {url} to {filename}")
+                urllib.request.urlretrieve(url, filename)
+            inputs[input_key] = filename
+            print(f"✅ {filename}")
 
         print("====================================")
 
     def connect(self):
-        self.client_id = str(uuid.uuid4())
-        self.ws = websocket.WebSocket()
-        self.ws.connect(f"ws://{self.server_address}/ws?clientId={self.client_id}")
+        # Starts the long-lived websocket session on first use. It reconnects
+        # by itself, so later calls only wait for it to be up.
+        with self.ws_lock:
+            if self.ws_thread is None:
+                self.ws_thread = threading.Thread(target=self.run_websocket, daemon=True)
+                self.ws_thread.start()
+        if not self.ws_connected.wait(60):
+            raise TimeoutError("Could not connect to the ComfyUI websocket")
+
+    def run_websocket(self):
+        delay = 0.1
+        while True:
+            try:
+                # Reconnecting with the same clientId resubscribes us to the
+                # events of prompts we queued before the drop
+                ws = websocket.WebSocket()
+                ws.connect(
+                    f"ws://{self.server_address}/ws?clientId={self.client_id}",
+                    timeout=10,
+                )
+                ws.settimeout(WEBSOCKET_HEARTBEAT)
+            except (websocket.WebSocketException, OSError) as e:
+                if self.ws_down_since is None:
+                    self.ws_down_since = time.time()
+                print(f"ComfyUI websocket connect failed: {e}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+                continue
+
+            delay = 0.1
+            self.ws = ws
+            self.ws_down_since = None
+            self.ws_connected.set()
+            try:
+                self.catch_up()
+                self.dispatch_messages(ws)
+            except (websocket.WebSocketException, OSError) as e:
+                print(f"ComfyUI websocket dropped: {e}, reconnecting")
+            self.ws_down_since = time.time()
+            self.ws_connected.clear()
+            ws.close()
+
+    def catch_up(self):
+        # Completions missed while disconnected are recovered from history
+        for prompt_id in self.router.reconnected():
+            entry = self.get_history_entry(prompt_id)
+            if entry is not None:
+                self.router.recover(prompt_id, entry)
+
+    def dispatch_messages(self, ws):
+        last_seen = time.time()
+        while True:
+            try:
+                opcode, frame = ws.recv_data_frame(True)
+            except websocket.WebSocketTimeoutException:
+                if time.time() - last_seen > WEBSOCKET_HEARTBEAT * 3:
+                    raise websocket.WebSocketException("heartbeat timed out")
+                ws.ping()
+                continue
+
+            last_seen = time.time()
+            if opcode == websocket.ABNF.OPCODE_CLOSE:
+                raise websocket.WebSocketConnectionClosedException("closed by server")
+            if opcode != websocket.ABNF.OPCODE_TEXT:
+                # Pongs, and binary previews which we don't use
+                continue
+
+            self.router.dispatch(json.loads(frame.data.decode("utf-8")))
+
+    @property
+    def last_activity(self):
+        return self.router.last_activity
+
+    def has_pending(self):
+        return self.router.has_pending()
+
+    def fail_pending(self, error):
+        # Wakes every waiter with the error, for when the server has gone
+        # away along with our prompts
+        return self.router.fail_pending(error)
+
+    def upload_image(self, filename, data, subfolder=""):
+        boundary = uuid.uuid4().hex
+        fields = {"overwrite": "true", "type": "input", "subfolder": subfolder}
+        body = b""
+        for name, value in fields.items():
+            body += (
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f"{value}\r\n"
+            ).encode("utf-8")
+        body += (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+        body += data + f"\r\n--{boundary}--\r\n".encode("utf-8")
+        headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+        status, payload = self.http.request("POST", "/upload/image", body, headers)
+        if status != 200:
+            raise Exception(f"Failed to upload {filename}, status code: {status}")
+
+        uploaded = json.loads(payload)
+        if uploaded.get("subfolder"):
+            return f"{uploaded['subfolder']}/{uploaded['name']}"
+        return uploaded["name"]
 
     def post_request(self, endpoint, data=None):
-        url = f"http://{self.server_address}{endpoint}"
         headers = {"Content-Type": "application/json"} if data else {}
         json_data = json.dumps(data).encode("utf-8") if data else None
-        req = urllib.request.Request(
-            url, data=json_data, headers=headers, method="POST"
-        )
-        with urllib.request.urlopen(req) as response:
-            if response.status != 200:
-                print(f"Failed: {endpoint}, status code: {response.status}")
+        status, _ = self.http.request("POST", endpoint, json_data, headers)
+        if status != 200:
+            print(f"Failed: {endpoint}, status code: {status}")
 
     # https://github.com/comfyanonymous/ComfyUI/blob/master/server.py
     def clear_queue(self):
         self.post_request("/queue", {"clear": True})
         self.post_request("/interrupt")
 
+    def get_queue(self):
+        _, data = self.http.request("GET", "/queue")
+        return json.loads(data)
+
+    def queue_depth(self):
+        queue = self.get_queue()
+        return len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+
+    def cancel(self, *prompt_ids):
+        # Only touches our own unfinished prompts, leaving everything else on
+        # the server alone
+        pending = self.router.cancel(prompt_ids)
+        if not pending:
+            return
+
+        print(f"Cancelling prompts {pending}")
+        self.post_request("/queue", {"delete": pending})
+        running = self.get_queue().get("queue_running", [])
+        if any(entry[1] in pending for entry in running):
+            self.post_request("/interrupt")
+
     def queue_prompt(self, prompt):
-        try:
-            # Prompt is the loaded workflow (prompt is the label comfyUI uses)
-            p = {"prompt": prompt, "client_id": self.client_id}
-            data = json.dumps(p).encode("utf-8")
-            req = urllib.request.Request(
-                f"http://{self.server_address}/prompt?{self.client_id}", data=data
-            )
+        # Prompt is the loaded workflow (prompt is the label comfyUI uses)
+        p = {"prompt": prompt, "client_id": self.client_id}
+        data = json.dumps(p).encode("utf-8")
+        status, body = self.http.request(
+            "POST", f"/prompt?{self.client_id}", data, endpoint="/prompt"
+        )
 
-            output = json.loads(urllib.request.urlopen(req).read())
+        if status == 200:
+            output = json.loads(body)
+            self.router.register(output["prompt_id"])
             return output["prompt_id"]
-        except urllib.error.HTTPError as e:
-            print(f"ComfyUI error: {e.code} {e.reason}")
-            http_error = True
-
-        if http_error:
-            raise Exception(
-                "ComfyUI Error – Your workflow could not be run. This usually happens if you’re trying to use an unsupported node. Check the logs for 'KeyError: ' details, and go to https://github.com/fofr/cog-comfyui to see the list of supported custom nodes."
-            )
+        else:
+            print(f"ComfyUI error: {status} {body.decode('utf-8', 'replace')}")
+            raise Exception(QUEUE_PROMPT_ERROR)
 
     def wait_for_prompt_completion(self, workflow, prompt_id):
-        while True:
-            out = self.ws.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-                if message["type"] == "executing":
-                    data = message["data"]
-                    if data["node"] is None and data["prompt_id"] == prompt_id:
-                        break
-                    elif data["prompt_id"] == prompt_id:
-                        node = workflow.get(data["node"], {})
-                        meta = node.get("_meta", {})
-                        class_type = node.get("class_type", "Unknown")
-                        print(
-                            f"Executing node {data['node']}, title: {meta.get('title', 'Unknown')}, class type: {class_type}"
-                        )
-            else:
-                continue
+        for _ in self.iter_prompt_outputs(workflow, prompt_id):
+            pass
+
+    def iter_prompt_outputs(self, workflow, prompt_id, node_id=None):
+        # Yields each image from `executed` events as soon as the node that
+        # saved it finishes, optionally only for a single output node. The
+        # prompt is cancelled if we stop waiting before it completes.
+        waiter, wait = self.router.wait(prompt_id, workflow, node_id)
+        try:
+            while not wait.completed:
+                for image in wait.handle(waiter.get()):
+                    yield image
+        finally:
+            if not self.router.finish(wait):
+                self.cancel(prompt_id)
 
     def load_workflow(self, workflow, check_inputs=True, check_weights=True):
+        wf = self.parse_workflow(workflow)
+
+        if check_inputs:
+            self.handle_inputs(wf)
+
+        if check_weights:
+            self.handle_weights(wf)
+
+        return wf
+
+    @staticmethod
+    def parse_workflow(workflow):
         if not isinstance(workflow, dict):
             wf = json.loads(workflow)
         else:
@@ -206,13 +331,6 @@ class ComfyUI:
             raise ValueError(
                 "You need to use the API JSON version of a ComfyUI workflow. To do this go to your ComfyUI settings and turn on 'Enable Dev mode Options'. Then you can save your ComfyUI workflow via the 'Save (API Format)' button."
             )
-
-        if check_inputs:
-            self.handle_inputs(wf)
-
-        if check_weights:
-            self.handle_weights(wf)
-
         return wf
 
     def randomise_input_seed(self, input_key, inputs):
@@ -228,17 +346,78 @@ class ComfyUI:
             for seed_key in seed_keys:
                 self.randomise_input_seed(seed_key, inputs)
 
-    def run_workflow(self, workflow):
+    def run_workflow(self, workflow, timer=None):
+        def stage(name):
+            return timer.stage(name) if timer else nullcontext()
+
         print("Running workflow")
-        prompt_id = self.queue_prompt(workflow)
-        self.wait_for_prompt_completion(workflow, prompt_id)
-        output_json = self.get_history(prompt_id)
+        with stage("queue_prompt"):
+            prompt_id = self.queue_prompt(workflow)
+        with stage("wait_for_completion"):
+            self.wait_for_prompt_completion(workflow, prompt_id)
+        with stage("get_history"):
+            output_json = self.get_history(prompt_id)
         print("outputs: ", output_json)
+        print(f"HTTP latency: {self.http.latency_report()}")
+        profile = self.get_profile(prompt_id)
+        if profile is not None:
+            print(f"Node timings: {profile.summary()}")
+        print(f"Cache hit ratios: {self.router.cache_hits.ratios()}")
         print("====================================")
+        return prompt_id, output_json
+
+    def run_workflows(self, workflows):
+        # Queue everything up front so the server goes straight from one
+        # prompt to the next, then wait for each in submission order
+        print(f"Running {len(workflows)} workflows")
+        prompt_ids = []
+        try:
+            for workflow in workflows:
+                prompt_ids.append(self.queue_prompt(workflow))
+            for workflow, prompt_id in zip(workflows, prompt_ids):
+                self.wait_for_prompt_completion(workflow, prompt_id)
+                print(f"Completed prompt {prompt_id}")
+        finally:
+            self.cancel(*prompt_ids)
+        print("====================================")
+        return prompt_ids
+
+    def collect_outputs(self, outputs, destination, node_id=None):
+        return [
+            self.fetch_output(image, destination)
+            for image in saved_images(outputs, node_id)
+        ]
+
+    def fetch_output(self, image, destination):
+        # Read in place when we share the server's output directory,
+        # otherwise download it through /view
+        local = local_output(self.output_directory, image)
+        if local:
+            return local
+
+        query = urllib.parse.urlencode(view_params(image))
+        status, data = self.http.request("GET", f"/view?{query}", endpoint="/view")
+        if status != 200:
+            raise Exception(f"Failed to fetch {image['filename']}, status code: {status}")
+
+        os.makedirs(destination, exist_ok=True)
+        path = os.path.join(destination, image["filename"])
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def server_for(self, prompt_id):
+        # The client that ran the prompt, a ComfyUIPool picks one of its servers
+        return self
+
+    def get_profile(self, prompt_id):
+        return self.router.get_profile(prompt_id)
+
+    def get_history_entry(self, prompt_id):
+        _, data = self.http.request(
+            "GET", f"/history/{prompt_id}", endpoint="/history/{prompt_id}"
+        )
+        return json.loads(data).get(prompt_id)
 
     def get_history(self, prompt_id):
-        with urllib.request.urlopen(
-            f"http://{self.server_address}/history/{prompt_id}"
-        ) as response:
-            output = json.loads(response.read())
-            return output[prompt_id]["outputs"]
+        return self.get_history_entry(prompt_id)["outputs"]
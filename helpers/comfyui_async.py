@@ -0,0 +1,331 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import aiohttp
+from contextlib import nullcontext
+from weights_downloader import WeightsDownloader
+from helpers.comfyui import ComfyUI, WEBSOCKET_HEARTBEAT
+from helpers.comfyui_common import (
+    PromptRouter,
+    QUEUE_PROMPT_ERROR,
+    url_inputs,
+    saved_images,
+    local_output,
+    view_params,
+)
+from helpers.comfyui_supervisor import ComfyUISupervisor
+from helpers.http_client import HTTPClient, HTTP_TIMEOUT
+
+
+class AsyncComfyUI:
+    # asyncio counterpart of ComfyUI, so one event loop can drive many
+    # prompts across many servers. Message routing, prompt tracking, workflow
+    # parsing and weight resolution are shared with the sync client, only
+    # the I/O differs.
+    def __init__(self, server_address, input_directory=None, weights_downloader=None):
+        self.server_address = server_address
+        self.input_directory = input_directory
+        self.output_directory = None
+        self.weights_downloader = weights_downloader or WeightsDownloader()
+        # Blocking probes for the supervisor, which runs in its own thread
+        self.http = HTTPClient(server_address)
+        self.client_id = str(uuid.uuid4())
+        self.session = None
+        self.consumer = None
+        self.loop = None
+        self.connected = asyncio.Event()
+        self.ws_down_since = None
+        self.router = PromptRouter(asyncio.Queue, self.deliver)
+        self.supervisor = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start_server(self, output_directory, input_directory, on_startup=None):
+        self.input_directory = input_directory
+        self.output_directory = output_directory
+        self.loop = asyncio.get_running_loop()
+
+        await asyncio.to_thread(self.weights_downloader.download_torch_checkpoints)
+
+        self.supervisor = ComfyUISupervisor(
+            [self], output_directory, input_directory, on_startup
+        )
+        if await asyncio.to_thread(self.supervisor.start):
+            raise TimeoutError("Server did not start within 60 seconds")
+
+        print("Server running")
+
+    def is_server_running(self):
+        try:
+            status, _ = self.http.request("GET", "/history/123", retries=0)
+            return status == 200
+        except OSError:
+            return False
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        if self.session is None:
+            # No session wide timeout, it would also apply to the websocket
+            self.session = aiohttp.ClientSession()
+        if self.consumer is None:
+            self.consumer = asyncio.create_task(self.run_websocket())
+        await asyncio.wait_for(self.connected.wait(), 60)
+
+    async def close(self):
+        if self.consumer is not None:
+            self.consumer.cancel()
+            self.consumer = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def run_websocket(self):
+        delay = 0.1
+        while True:
+            try:
+                # The same clientId resubscribes us after a reconnect
+                ws = await self.session.ws_connect(
+                    f"ws://{self.server_address}/ws?clientId={self.client_id}",
+                    heartbeat=WEBSOCKET_HEARTBEAT,
+                )
+            except (aiohttp.ClientError, OSError) as e:
+                if self.ws_down_since is None:
+                    self.ws_down_since = time.time()
+                print(f"ComfyUI websocket connect failed: {e}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+                continue
+
+            delay = 0.1
+            self.ws_down_since = None
+            self.connected.set()
+            try:
+                await self.catch_up()
+                await self.consume(ws)
+            except (aiohttp.ClientError, OSError) as e:
+                print(f"ComfyUI websocket dropped: {e}, reconnecting")
+            finally:
+                self.ws_down_since = time.time()
+                self.connected.clear()
+                await ws.close()
+
+    async def consume(self, ws):
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                # Binary previews, which we don't use
+                continue
+
+            self.router.dispatch(json.loads(msg.data))
+
+    async def catch_up(self):
+        # Completions missed while disconnected are recovered from history
+        for prompt_id in self.router.reconnected():
+            entry = await self.get_history_entry(prompt_id)
+            if entry is not None:
+                self.router.recover(prompt_id, entry)
+
+    def deliver(self, waiter, item):
+        # Waiters belong to the event loop, the supervisor fails them from
+        # its own thread
+        self.loop.call_soon_threadsafe(waiter.put_nowait, item)
+
+    @property
+    def last_activity(self):
+        return self.router.last_activity
+
+    def has_pending(self):
+        return self.router.has_pending()
+
+    def fail_pending(self, error):
+        return self.router.fail_pending(error)
+
+    async def request(self, method, endpoint, data=None, form=None, **kwargs):
+        # data is sent as JSON, form as multipart
+        if data is not None:
+            kwargs["json"] = data
+        if form is not None:
+            kwargs["data"] = form
+        async with self.session.request(
+            method,
+            f"http://{self.server_address}{endpoint}",
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+            **kwargs,
+        ) as response:
+            return response.status, await response.read()
+
+    async def upload_image(self, filename, data, subfolder=""):
+        form = aiohttp.FormData()
+        form.add_field("overwrite", "true")
+        form.add_field("type", "input")
+        form.add_field("subfolder", subfolder)
+        form.add_field(
+            "image", data, filename=filename, content_type="application/octet-stream"
+        )
+        status, payload = await self.request("POST", "/upload/image", form=form)
+        if status != 200:
+            raise Exception(f"Failed to upload {filename}, status code: {status}")
+
+        uploaded = json.loads(payload)
+        if uploaded.get("subfolder"):
+            return f"{uploaded['subfolder']}/{uploaded['name']}"
+        return uploaded["name"]
+
+    async def post_request(self, endpoint, data=None):
+        status, _ = await self.request("POST", endpoint, data)
+        if status != 200:
+            print(f"Failed: {endpoint}, status code: {status}")
+
+    async def clear_queue(self):
+        await self.post_request("/queue", {"clear": True})
+        await self.post_request("/interrupt")
+
+    async def get_queue(self):
+        _, data = await self.request("GET", "/queue")
+        return json.loads(data)
+
+    async def queue_depth(self):
+        queue = await self.get_queue()
+        return len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+
+    async def cancel(self, *prompt_ids):
+        # Only touches our own unfinished prompts
+        pending = self.router.cancel(prompt_ids)
+        if not pending:
+            return
+
+        print(f"Cancelling prompts {pending}")
+        await self.post_request("/queue", {"delete": pending})
+        running = (await self.get_queue()).get("queue_running", [])
+        if any(entry[1] in pending for entry in running):
+            await self.post_request("/interrupt")
+
+    async def queue_prompt(self, prompt):
+        status, body = await self.request(
+            "POST", "/prompt", {"prompt": prompt, "client_id": self.client_id}
+        )
+        if status != 200:
+            print(f"ComfyUI error: {status} {body.decode('utf-8', 'replace')}")
+            raise Exception(QUEUE_PROMPT_ERROR)
+
+        prompt_id = json.loads(body)["prompt_id"]
+        self.router.register(prompt_id)
+        return prompt_id
+
+    async def wait_for_prompt_completion(self, workflow, prompt_id):
+        async for _ in self.iter_prompt_outputs(workflow, prompt_id):
+            pass
+
+    async def iter_prompt_outputs(self, workflow, prompt_id, node_id=None):
+        waiter, wait = self.router.wait(prompt_id, workflow, node_id)
+        try:
+            while not wait.completed:
+                for image in wait.handle(await waiter.get()):
+                    yield image
+        finally:
+            if not self.router.finish(wait):
+                await self.cancel(prompt_id)
+
+    async def get_history_entry(self, prompt_id):
+        _, data = await self.request("GET", f"/history/{prompt_id}")
+        return json.loads(data).get(prompt_id)
+
+    async def get_history(self, prompt_id):
+        return (await self.get_history_entry(prompt_id))["outputs"]
+
+    async def handle_weights(self, workflow):
+        print("Checking weights")
+        # pget does the transfer, it runs off the event loop
+        weights = ComfyUI.weights_to_download(workflow)
+        await asyncio.to_thread(self.weights_downloader.download_all, weights)
+        print("====================================")
+
+    async def handle_inputs(self, workflow):
+        print("Checking inputs")
+        for inputs, input_key, url, filename in url_inputs(
+            workflow, self.input_directory
+        ):
+            if not os.path.exists(filename):
+                print(f"Downloading {url} to {filename}")
+                await self.download_input(url, filename)
+            inputs[input_key] = filename
+            print(f"✅ {filename}")
+
+        print("====================================")
+
+    async def download_input(self, url, filename):
+        async with self.session.get(
+            url, timeout=aiohttp.ClientTimeout(total=None)
+        ) as response:
+            response.raise_for_status()
+            data = await response.read()
+        await asyncio.to_thread(self.write_file, filename, data)
+
+    @staticmethod
+    def write_file(filename, data):
+        with open(filename, "wb") as f:
+            f.write(data)
+
+    async def load_workflow(self, workflow, check_inputs=True, check_weights=True):
+        wf = ComfyUI.parse_workflow(workflow)
+
+        if check_inputs:
+            await self.handle_inputs(wf)
+
+        if check_weights:
+            await self.handle_weights(wf)
+
+        return wf
+
+    async def run_workflow(self, workflow, timer=None):
+        def stage(name):
+            return timer.stage(name) if timer else nullcontext()
+
+        print("Running workflow")
+        with stage("queue_prompt"):
+            prompt_id = await self.queue_prompt(workflow)
+        with stage("wait_for_completion"):
+            await self.wait_for_prompt_completion(workflow, prompt_id)
+        with stage("get_history"):
+            output_json = await self.get_history(prompt_id)
+        print("outputs: ", output_json)
+        profile = self.get_profile(prompt_id)
+        if profile is not None:
+            print(f"Node timings: {profile.summary()}")
+        print(f"Cache hit ratios: {self.router.cache_hits.ratios()}")
+        print("====================================")
+        return prompt_id, output_json
+
+    async def collect_outputs(self, outputs, destination, node_id=None):
+        return [
+            await self.fetch_output(image, destination)
+            for image in saved_images(outputs, node_id)
+        ]
+
+    async def fetch_output(self, image, destination):
+        # Read in place when we share the server's output directory,
+        # otherwise download it through /view
+        local = local_output(self.output_directory, image)
+        if local:
+            return local
+
+        status, data = await self.request("GET", "/view", params=view_params(image))
+        if status != 200:
+            raise Exception(f"Failed to fetch {image['filename']}, status code: {status}")
+
+        os.makedirs(destination, exist_ok=True)
+        path = os.path.join(destination, image["filename"])
+        await asyncio.to_thread(self.write_file, path, data)
+        return path
+
+    def server_for(self, prompt_id):
+        return self
+
+    def get_profile(self, prompt_id):
+        return self.router.get_profile(prompt_id)
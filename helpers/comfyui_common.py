@@ -0,0 +1,255 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from helpers.prompt_profile import PromptProfile, CacheHitRatios
+
+# Completed prompt profiles kept for lookup by prompt_id
+MAX_PROFILES = 100
+
+# Prompts whose messages arrived before anyone registered to wait on them
+MAX_UNCLAIMED = 100
+
+QUEUE_PROMPT_ERROR = "ComfyUI Error – Your workflow could not be run. This usually happens if you’re trying to use an unsupported node. Check the logs for 'KeyError: ' details, and go to https://github.com/fofr/cog-comfyui to see the list of supported custom nodes."
+
+
+class PromptRouter:
+    # The I/O free half of a ComfyUI client, shared by ComfyUI and
+    # AsyncComfyUI. Websocket messages are routed to per-prompt waiters by
+    # prompt_id, waiters are failed when the server goes away and every
+    # completed prompt leaves a profile. The client supplies its kind of
+    # queue and how to put on it from any thread.
+    def __init__(self, new_waiter, deliver):
+        self.new_waiter = new_waiter
+        self.deliver = deliver
+        self.waiters = {}
+        # Waiters failed before anyone waited on them, holding their error
+        self.failed = OrderedDict()
+        self.unclaimed = {}
+        self.queued_at = {}
+        self.profiles = OrderedDict()
+        self.cache_hits = CacheHitRatios()
+        self.executing = None
+        self.lock = threading.Lock()
+        # Last sign of life from the server, the supervisor restarts it when
+        # this goes stale while prompts are pending
+        self.last_activity = time.time()
+
+    def dispatch(self, message):
+        # A text message from the websocket. Pongs come from the server's
+        # event loop even while execution is stuck, so only these count as
+        # progress.
+        self.last_activity = time.time()
+        data = message.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if prompt_id and message["type"] in ["execution_start", "executing"]:
+            self.executing = prompt_id
+        elif prompt_id is None and message["type"] == "progress":
+            # Progress isn't tagged, it belongs to whatever is executing
+            data["prompt_id"] = prompt_id = self.executing
+        if prompt_id is not None:
+            self.route(prompt_id, message)
+
+    def route(self, prompt_id, message):
+        message.setdefault("received_at", time.time())
+        with self.lock:
+            waiter = self.waiters.get(prompt_id)
+            if waiter is None:
+                # Can arrive before queue_prompt has registered the waiter
+                self.unclaimed.setdefault(prompt_id, []).append(message)
+                while len(self.unclaimed) > MAX_UNCLAIMED:
+                    self.unclaimed.pop(next(iter(self.unclaimed)))
+                return
+        self.deliver(waiter, message)
+
+    def reconnected(self):
+        # Returns the prompts whose completion may have been missed while
+        # the websocket was down
+        self.executing = None
+        with self.lock:
+            return list(self.waiters)
+
+    def recover(self, prompt_id, entry):
+        # Replays a history entry as the messages we would have received
+        print(f"Recovered completion of prompt {prompt_id} from history")
+        for node_id, output in entry.get("outputs", {}).items():
+            self.route(
+                prompt_id,
+                {
+                    "type": "executed",
+                    "data": {"node": node_id, "output": output, "prompt_id": prompt_id},
+                },
+            )
+        self.route(
+            prompt_id,
+            {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}},
+        )
+
+    def register(self, prompt_id):
+        waiter = self.new_waiter()
+        with self.lock:
+            for message in self.unclaimed.pop(prompt_id, []):
+                self.deliver(waiter, message)
+            if not self.waiters:
+                self.last_activity = time.time()
+            self.waiters[prompt_id] = waiter
+            self.queued_at[prompt_id] = time.time()
+
+    def has_pending(self):
+        with self.lock:
+            return bool(self.waiters)
+
+    def fail_pending(self, error):
+        # Wakes every waiter with the error, for when the server has gone
+        # away along with our prompts
+        with self.lock:
+            waiters, self.waiters = self.waiters, {}
+            for prompt_id, waiter in waiters.items():
+                self.deliver(waiter, error)
+                self.failed[prompt_id] = waiter
+            while len(self.failed) > MAX_PROFILES:
+                self.failed.popitem(last=False)
+        return list(waiters)
+
+    def cancel(self, prompt_ids):
+        # Returns the prompts that were still ours to cancel
+        with self.lock:
+            pending = [p for p in prompt_ids if p in self.waiters]
+            for prompt_id in pending:
+                self.deliver(
+                    self.waiters.pop(prompt_id),
+                    InterruptedError(f"Prompt {prompt_id} cancelled"),
+                )
+        return pending
+
+    def wait(self, prompt_id, workflow, node_id=None):
+        # Returns the waiter to read messages from and the PromptWait that
+        # interprets them
+        with self.lock:
+            waiter = self.waiters.get(prompt_id)
+            if waiter is None:
+                # Failed by a restart before we got here, the error is queued
+                waiter = self.failed.pop(prompt_id)
+            queued_at = self.queued_at.pop(prompt_id, None)
+        return waiter, PromptWait(prompt_id, workflow, queued_at, node_id)
+
+    def finish(self, wait):
+        # Returns False when the prompt didn't complete and should be
+        # cancelled
+        if not wait.completed:
+            return False
+        with self.lock:
+            self.waiters.pop(wait.prompt_id, None)
+            self.profiles[wait.prompt_id] = wait.profile
+            while len(self.profiles) > MAX_PROFILES:
+                self.profiles.popitem(last=False)
+        self.cache_hits.add(wait.profile)
+        return True
+
+    def get_profile(self, prompt_id):
+        with self.lock:
+            return self.profiles.get(prompt_id)
+
+
+class PromptWait:
+    # Follows one prompt's messages until it completes, handing back each
+    # image as soon as the node that saved it finishes, optionally only for
+    # a single output node
+    def __init__(self, prompt_id, workflow, queued_at=None, node_id=None):
+        self.prompt_id = prompt_id
+        self.workflow = workflow
+        self.node_id = node_id
+        self.profile = PromptProfile(prompt_id, workflow, queued_at)
+        self.completed = False
+        # Nodes already reported, history catch up after a reconnect can
+        # repeat them
+        self.seen_nodes = set()
+
+    def handle(self, message):
+        if isinstance(message, Exception):
+            raise message
+        data = message["data"]
+        self.profile.record(message)
+
+        if message["type"] == "executing":
+            if data["node"] is None:
+                self.completed = True
+                return []
+            node = self.workflow.get(data["node"], {})
+            meta = node.get("_meta", {})
+            class_type = node.get("class_type", "Unknown")
+            print(
+                f"Executing node {data['node']}, title: {meta.get('title', 'Unknown')}, class type: {class_type}"
+            )
+        elif message["type"] == "node_cache_hit":
+            print(
+                f"Node cache served node {data['node']}, class type: {data['class_type']}"
+            )
+        elif message["type"] == "executed":
+            if self.node_id is not None and data["node"] != self.node_id:
+                return []
+            if data["node"] in self.seen_nodes:
+                return []
+            self.seen_nodes.add(data["node"])
+            output = data.get("output") or {}
+            return output.get("images", [])
+        return []
+
+
+def is_image_or_video_value(value):
+    filetypes = [".png", ".jpg", ".jpeg", ".webp", ".mp4", ".webm"]
+    return isinstance(value, str) and any(
+        value.lower().endswith(ft) for ft in filetypes
+    )
+
+
+def url_inputs(workflow, input_directory):
+    # Reports whether each file input is in place, and yields
+    # (inputs, input_key, url, filename) for URL inputs for the client to
+    # download before pointing the input at the file
+    seen_inputs = set()
+    for node in workflow.values():
+        for input_key, input_value in node.get("inputs", {}).items():
+            if not isinstance(input_value, str) or input_value in seen_inputs:
+                continue
+            seen_inputs.add(input_value)
+
+            if input_value.startswith(("http://", "https://")):
+                filename = os.path.join(input_directory, os.path.basename(input_value))
+                yield node["inputs"], input_key, input_value, filename
+            elif is_image_or_video_value(input_value):
+                # Names can include a subfolder of the inputs
+                filename = os.path.join(input_directory, input_value)
+                if not os.path.exists(filename):
+                    print(f"❌ {filename} not provided")
+                else:
+                    print(f"✅ {filename}")
+
+
+def saved_images(outputs, node_id=None):
+    # The exact files the output nodes saved, according to the history
+    images = []
+    for output_node_id, output in outputs.items():
+        if node_id is not None and output_node_id != node_id:
+            continue
+        for image in output.get("images", []):
+            if image.get("type", "output") == "output":
+                images.append(image)
+    return images
+
+
+def local_output(output_directory, image):
+    # The saved file, when we share the server's output directory
+    if output_directory:
+        path = os.path.join(output_directory, image["subfolder"], image["filename"])
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def view_params(image):
+    return {
+        "filename": image["filename"],
+        "subfolder": image["subfolder"],
+        "type": image.get("type", "output"),
+    }
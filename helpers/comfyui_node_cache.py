@@ -0,0 +1,219 @@
+# Runs the ComfyUI server with a multi-entry LRU cache of node outputs.
+#
+# ComfyUI only reuses outputs from the immediately previous prompt, so when
+# requests interleave every node is recomputed. This wraps
+# execution.recursive_execute to serve node outputs from an LRU keyed by
+# class type and the full signature of the node's inputs, including all of
+# its upstream nodes.
+#
+# Usage: python ./helpers/comfyui_node_cache.py <ComfyUI main.py arguments>
+
+import os
+import sys
+import json
+import runpy
+import hashlib
+import inspect
+import importlib.abc
+import importlib.util
+from collections import OrderedDict
+
+COMFYUI_MAIN = os.path.join(os.path.dirname(__file__), "..", "ComfyUI", "main.py")
+RAM_BUDGET_MB = int(os.environ.get("COMFYUI_NODE_CACHE_RAM_MB", 4096))
+VRAM_BUDGET_MB = int(os.environ.get("COMFYUI_NODE_CACHE_VRAM_MB", 2048))
+MAX_ENTRIES = int(os.environ.get("COMFYUI_NODE_CACHE_MAX_ENTRIES", 64))
+
+
+def output_size(value):
+    # Returns (ram_bytes, vram_bytes) held by tensors in a node output, or
+    # None when it holds anything else. Patched models, control nets and
+    # conditioning that references them keep memory we can't measure, so
+    # they aren't cached. Loaders don't need to be, their inputs never change
+    # and ComfyUI's own cache keeps them.
+    ram, vram = 0, 0
+    if hasattr(value, "element_size") and hasattr(value, "nelement"):
+        size = value.element_size() * value.nelement()
+        if getattr(value, "is_cuda", False):
+            vram += size
+        else:
+            ram += size
+    elif isinstance(value, (dict, list, tuple)):
+        items = value.values() if isinstance(value, dict) else value
+        for item in items:
+            size = output_size(item)
+            if size is None:
+                return None
+            ram += size[0]
+            vram += size[1]
+    elif not isinstance(value, (str, int, float, bool, type(None))):
+        return None
+    return ram, vram
+
+
+class NodeOutputCache:
+    def __init__(self, ram_budget, vram_budget, max_entries=MAX_ENTRIES):
+        self.ram_budget = ram_budget
+        self.vram_budget = vram_budget
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.ram_used = 0
+        self.vram_used = 0
+        self.served = {}
+        self.signatures = {}
+        self.signatures_prompt = None
+
+    def signature(self, prompt, node_id, prompt_id):
+        import nodes
+
+        if self.signatures_prompt != prompt_id:
+            self.signatures = {}
+            self.signatures_prompt = prompt_id
+        if node_id in self.signatures:
+            return self.signatures[node_id]
+
+        node = prompt[node_id]
+        class_type = node["class_type"]
+        class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type)
+        signature = None
+
+        # Output nodes have side effects, so they always run
+        if class_def is not None and not getattr(class_def, "OUTPUT_NODE", False):
+            parts = [class_type]
+            literal_inputs = {}
+            for key, value in sorted(node["inputs"].items()):
+                if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+                    upstream = self.signature(prompt, value[0], prompt_id)
+                    if upstream is None:
+                        break
+                    parts.append([key, upstream, value[1]])
+                else:
+                    literal_inputs[key] = value
+                    parts.append([key, value])
+            else:
+                changed = self.is_changed(class_def, literal_inputs)
+                # NaN means the node wants to run every time
+                if changed == changed:
+                    parts.append(["is_changed", changed])
+                    signature = hashlib.sha256(
+                        json.dumps(parts, default=str).encode("utf-8")
+                    ).hexdigest()
+
+        self.signatures[node_id] = signature
+        return signature
+
+    def is_changed(self, class_def, literal_inputs):
+        # Nodes like LoadImage hash their file here, so a changed file with
+        # the same name is a different entry
+        if not hasattr(class_def, "IS_CHANGED"):
+            return ""
+        try:
+            return class_def.IS_CHANGED(**literal_inputs)
+        except Exception:
+            return float("NaN")
+
+    def get(self, signature):
+        if signature in self.entries:
+            self.entries.move_to_end(signature)
+            return self.entries[signature][0]
+        return None
+
+    def put(self, signature, output):
+        if signature in self.entries:
+            return
+        size = output_size(output)
+        if size is None:
+            return
+        ram, vram = size
+        if ram > self.ram_budget or vram > self.vram_budget:
+            return
+        self.entries[signature] = (output, ram, vram)
+        self.ram_used += ram
+        self.vram_used += vram
+
+        while (
+            self.ram_used > self.ram_budget
+            or self.vram_used > self.vram_budget
+            or len(self.entries) > self.max_entries
+        ):
+            _, (_, ram, vram) = self.entries.popitem(last=False)
+            self.ram_used -= ram
+            self.vram_used -= vram
+
+    def record_served(self, class_type):
+        self.served[class_type] = self.served.get(class_type, 0) + 1
+
+
+def install(execution):
+    if not hasattr(execution, "recursive_execute"):
+        print("Node cache: execution.recursive_execute not found, not installed")
+        return
+
+    cache = NodeOutputCache(RAM_BUDGET_MB * 1024**2, VRAM_BUDGET_MB * 1024**2)
+    original = execution.recursive_execute
+    parameters = inspect.signature(original)
+
+    def recursive_execute(*args, **kwargs):
+        arguments = parameters.bind(*args, **kwargs).arguments
+        server = arguments["server"]
+        prompt = arguments["prompt"]
+        outputs = arguments["outputs"]
+        node_id = arguments["current_item"]
+        prompt_id = arguments["prompt_id"]
+
+        if node_id in outputs:
+            return original(*args, **kwargs)
+
+        signature = cache.signature(prompt, node_id, prompt_id)
+        cached = cache.get(signature) if signature else None
+        if cached is not None:
+            class_type = prompt[node_id]["class_type"]
+            outputs[node_id] = cached
+            arguments["executed"].add(node_id)
+            cache.record_served(class_type)
+            print(f"Node cache served node {node_id} ({class_type})")
+            server.send_sync(
+                "node_cache_hit",
+                {"node": node_id, "class_type": class_type, "prompt_id": prompt_id},
+                server.client_id,
+            )
+            return (True, None, None)
+
+        result = original(*args, **kwargs)
+        if signature and result[0] and node_id in outputs:
+            cache.put(signature, outputs[node_id])
+        return result
+
+    execution.recursive_execute = recursive_execute
+    execution.node_output_cache = cache
+    print(
+        f"Node cache installed, budget {RAM_BUDGET_MB}MB RAM, {VRAM_BUDGET_MB}MB VRAM, {MAX_ENTRIES} entries"
+    )
+
+
+class PatchExecutionOnImport(importlib.abc.MetaPathFinder):
+    # main.py has to configure arguments and CUDA before execution is
+    # imported, so patch it as it loads rather than importing it ourselves
+    def find_spec(self, name, path, target=None):
+        if name != "execution":
+            return None
+        sys.meta_path.remove(self)
+        spec = importlib.util.find_spec(name)
+        exec_module = spec.loader.exec_module
+
+        def exec_and_install(module):
+            exec_module(module)
+            install(module)
+
+        spec.loader.exec_module = exec_and_install
+        return spec
+
+
+if __name__ == "__main__":
+    # Marks the end of interpreter start up in the supervisor's timeline
+    print("ComfyUI launcher started", flush=True)
+    main = os.path.realpath(COMFYUI_MAIN)
+    # As if main.py had been run directly, instead of from helpers/
+    sys.path[0] = os.path.dirname(main)
+    sys.argv[0] = main
+    sys.meta_path.insert(0, PatchExecutionOnImport())
+    runpy.run_path(main, run_name="__main__")
@@ -0,0 +1,254 @@
+import time
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from weights_downloader import WeightsDownloader
+from helpers.comfyui import ComfyUI
+from helpers.comfyui_supervisor import ComfyUISupervisor
+
+# Seconds a failing server is kept out of rotation before it is probed again,
+# doubling after every failed probe
+DRAIN_BACKOFF = 5
+MAX_DRAIN_BACKOFF = 120
+
+# Prompt to server routes kept for later history and output lookups
+MAX_ROUTES = 1000
+
+LOCAL_HOSTS = ["127.0.0.1", "localhost", "0.0.0.0"]
+
+# Seconds the websocket of a server we don't supervise can stay down before
+# its in-flight prompts are failed and it is drained
+REMOTE_DOWN_TIMEOUT = 30
+MONITOR_INTERVAL = 1
+
+
+class ComfyUIPool:
+    # Same interface as ComfyUI, spread over several servers. Each prompt goes
+    # to the healthy server with the shortest queue, ties broken by recent
+    # latency. Servers that fail are drained and re-admitted once they answer.
+    def __init__(self, server_addresses):
+        weights_downloader = WeightsDownloader()
+        self.servers = [
+            ComfyUI(address, weights_downloader) for address in server_addresses
+        ]
+        self.drained = {}
+        self.routes = OrderedDict()
+        self.lock = threading.Lock()
+        self.route_lock = threading.Lock()
+        self.supervisor = None
+        self.remote = []
+        self.monitor_thread = None
+
+    def start_server(self, output_directory, input_directory, on_startup=None):
+        # Local servers are supervised here, anything else is expected to be up
+        self.servers[0].download_pre_start_models()
+        local = []
+        for server in self.servers:
+            server.input_directory = input_directory
+            server.output_directory = output_directory
+            if server.server_address.rsplit(":", 1)[0] in LOCAL_HOSTS:
+                local.append(server)
+            else:
+                self.remote.append(server)
+
+        self.supervisor = ComfyUISupervisor(
+            local, output_directory, input_directory, on_startup
+        )
+        for server in self.supervisor.start():
+            # Drained until the supervisor gets it up
+            self.drain(server, TimeoutError("Server did not start within 60 seconds"))
+
+        if self.remote:
+            self.monitor_thread = threading.Thread(target=self.monitor, daemon=True)
+            self.monitor_thread.start()
+
+        if not self.healthy_servers():
+            raise TimeoutError("No ComfyUI server started")
+        print(f"Server pool running: {[s.server_address for s in self.servers]}")
+
+    def connect(self):
+        for server in self.healthy_servers():
+            try:
+                server.connect()
+            except TimeoutError as e:
+                self.drain(server, e)
+
+    def drain(self, server, error):
+        with self.lock:
+            if server.server_address in self.drained:
+                return
+            print(f"⚠️  Draining ComfyUI server {server.server_address}: {error}")
+            self.drained[server.server_address] = (
+                time.time() + DRAIN_BACKOFF,
+                DRAIN_BACKOFF,
+            )
+
+    def monitor(self):
+        # Nothing restarts a remote server, so when one dies its prompts are
+        # failed here rather than left waiting for completions that never come
+        while True:
+            time.sleep(MONITOR_INTERVAL)
+            for server in self.remote:
+                down_since = server.ws_down_since
+                if down_since is None or not server.has_pending():
+                    continue
+                down = time.time() - down_since
+                if down < REMOTE_DOWN_TIMEOUT:
+                    continue
+                error = RuntimeError(
+                    f"ComfyUI server {server.server_address} unreachable for {down:.0f}s"
+                )
+                failed = server.fail_pending(error)
+                if failed:
+                    print(f"Failed prompts {failed}")
+                self.drain(server, error)
+
+    def healthy_servers(self):
+        # Drained servers are probed once their backoff has passed. Probes
+        # happen outside the lock, a slow one mustn't hold up routing.
+        servers = []
+        due = []
+        with self.lock:
+            for server in self.servers:
+                address = server.server_address
+                if address not in self.drained:
+                    servers.append(server)
+                elif time.time() >= self.drained[address][0]:
+                    due.append(server)
+
+        for server in due:
+            running = server.is_server_running()
+            address = server.server_address
+            with self.lock:
+                if address not in self.drained:
+                    servers.append(server)
+                    continue
+                if not running:
+                    _, backoff = self.drained[address]
+                    backoff = min(backoff * 2, MAX_DRAIN_BACKOFF)
+                    self.drained[address] = (time.time() + backoff, backoff)
+                    continue
+                print(f"✅ Re-admitting ComfyUI server {address}")
+                del self.drained[address]
+            servers.append(server)
+
+        # Keeps the pool's order, which callers fall back on for ties
+        return [server for server in self.servers if server in servers]
+
+    def ranked_servers(self):
+        ranked = []
+        for server in self.healthy_servers():
+            try:
+                depth = server.queue_depth()
+            except OSError as e:
+                self.drain(server, e)
+                continue
+            latency = server.http.recent_latency("GET /queue") or 0
+            ranked.append((depth, latency, server))
+        ranked.sort(key=lambda r: r[:2])
+        return [server for _, _, server in ranked]
+
+    def queue_prompt(self, prompt):
+        # Connecting can wait up to a minute on a server that is down, so it
+        # happens outside the lock, draining any server that fails. Routing
+        # is serialised so concurrent callers see each other's prompts in the
+        # queue depths.
+        self.connect()
+        with self.route_lock:
+            for server in self.ranked_servers():
+                if server.ws_thread is None:
+                    # Re-admitted since we connected, nothing would hear its
+                    # events. One that is reconnecting catches up by itself.
+                    continue
+                try:
+                    prompt_id = server.queue_prompt(prompt)
+                except (OSError, TimeoutError) as e:
+                    self.drain(server, e)
+                    continue
+                with self.lock:
+                    self.routes[prompt_id] = server
+                    while len(self.routes) > MAX_ROUTES:
+                        self.routes.popitem(last=False)
+                print(f"Queued prompt {prompt_id} on {server.server_address}")
+                return prompt_id
+        raise Exception("No healthy ComfyUI server available")
+
+    def server_for(self, prompt_id):
+        with self.lock:
+            return self.routes[prompt_id]
+
+    def upload_image(self, filename, data, subfolder=""):
+        # Any server can end up running the prompt, so every one gets a copy
+        name = None
+        for server in self.healthy_servers():
+            try:
+                name = server.upload_image(filename, data, subfolder)
+            except OSError as e:
+                self.drain(server, e)
+        if name is None:
+            raise Exception("No healthy ComfyUI server available")
+        return name
+
+    def cancel(self, *prompt_ids):
+        by_server = {}
+        with self.lock:
+            for prompt_id in prompt_ids:
+                if prompt_id in self.routes:
+                    by_server.setdefault(self.routes[prompt_id], []).append(prompt_id)
+        for server, server_prompt_ids in by_server.items():
+            try:
+                server.cancel(*server_prompt_ids)
+            except OSError as e:
+                self.drain(server, e)
+
+    def wait_for_prompt_completion(self, workflow, prompt_id):
+        self.server_for(prompt_id).wait_for_prompt_completion(workflow, prompt_id)
+
+    def iter_prompt_outputs(self, workflow, prompt_id, node_id=None):
+        return self.server_for(prompt_id).iter_prompt_outputs(
+            workflow, prompt_id, node_id
+        )
+
+    def get_history(self, prompt_id):
+        return self.server_for(prompt_id).get_history(prompt_id)
+
+    def get_profile(self, prompt_id):
+        return self.server_for(prompt_id).get_profile(prompt_id)
+
+    def load_workflow(self, workflow, check_inputs=True, check_weights=True):
+        # Weights and inputs live on local disk, one check covers the pool
+        return self.servers[0].load_workflow(workflow, check_inputs, check_weights)
+
+    def run_workflow(self, workflow, timer=None):
+        def stage(name):
+            return timer.stage(name) if timer else nullcontext()
+
+        print("Running workflow")
+        with stage("queue_prompt"):
+            prompt_id = self.queue_prompt(workflow)
+        server = self.server_for(prompt_id)
+        with stage("wait_for_completion"):
+            server.wait_for_prompt_completion(workflow, prompt_id)
+        with stage("get_history"):
+            output_json = server.get_history(prompt_id)
+        print("outputs: ", output_json)
+        print(f"HTTP latency ({server.server_address}): {server.http.latency_report()}")
+        profile = server.get_profile(prompt_id)
+        if profile is not None:
+            print(f"Node timings: {profile.summary()}")
+        print("====================================")
+        return prompt_id, output_json
+
+    def run_workflows(self, workflows):
+        print(f"Running {len(workflows)} workflows")
+        prompt_ids = []
+        try:
+            for workflow in workflows:
+                prompt_ids.append(self.queue_prompt(workflow))
+            for workflow, prompt_id in zip(workflows, prompt_ids):
+                self.wait_for_prompt_completion(workflow, prompt_id)
+                print(f"Completed prompt {prompt_id}")
+        finally:
+            self.cancel(*prompt_ids)
+        print("====================================")
+        return prompt_ids
@@ -0,0 +1,330 @@
+import os
+import re
+import sys
+import time
+import signal
+import socket
+import json
+import threading
+import subprocess
+from collections import deque
+from helpers.http_client import HTTPClient
+
+# Serve node outputs from a multi-entry LRU across prompts, see
+# helpers/comfyui_node_cache.py. Disable with COMFYUI_NODE_CACHE=0
+NODE_CACHE = os.environ.get("COMFYUI_NODE_CACHE", "1") == "1"
+
+# Seconds without a websocket message, while we have prompts on the server,
+# before it is considered hung and restarted
+HANG_TIMEOUT = float(os.environ.get("COMFYUI_HANG_TIMEOUT", 300))
+
+# Comma separated CUDA devices, local servers are spread over them in order
+CUDA_DEVICES = [d for d in os.environ.get("COMFYUI_CUDA_DEVICES", "").split(",") if d]
+
+STARTUP_TIMEOUT = 60
+MONITOR_INTERVAL = 1
+MAX_RESTART_DELAY = 30
+
+# Server output lines kept to explain a crash
+LOG_TAIL = 200
+
+# Fallback readiness probing, for when the output doesn't tell us
+PROBE_DELAY = 0.05
+MAX_PROBE_DELAY = 1
+
+# Boot phases, marked by the first line of server output matching each
+STARTUP_MARKERS = [
+    ("interpreter_start", "ComfyUI launcher started"),
+    ("custom_nodes_imported", "Import times for custom nodes:"),
+    ("server_starting", "Starting server"),
+    ("listener_ready", "To see the GUI go to:"),
+]
+CUSTOM_NODE_IMPORT = re.compile(r"^\s*([\d.]+) seconds( \(IMPORT FAILED\))?: (.+)$")
+
+
+class ManagedServer:
+    def __init__(self, client, cuda_device=None):
+        self.client = client
+        self.cuda_device = cuda_device
+        self.process = None
+        self.reattached = False
+        self.started_at = None
+        self.restart_at = None
+        self.log = deque(maxlen=LOG_TAIL)
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.timeline = {}
+        self.custom_node_imports = {}
+        self.restarts = 0
+        self.failed_probes = 0
+
+    @property
+    def port(self):
+        return int(self.client.server_address.rsplit(":", 1)[1])
+
+
+class ComfyUISupervisor:
+    # Owns the local ComfyUI server processes of a set of clients: starts
+    # them, or reattaches to ones already running, captures their output,
+    # restarts them when they exit and kills them when they hang
+    def __init__(self, clients, output_directory, input_directory, on_startup=None):
+        self.output_directory = output_directory
+        self.input_directory = input_directory
+        # Called with the startup timeline record of every (re)start
+        self.on_startup = on_startup
+        self.servers = [
+            ManagedServer(client, CUDA_DEVICES[i % len(CUDA_DEVICES)] if CUDA_DEVICES else None)
+            for i, client in enumerate(clients)
+        ]
+        self.monitor_thread = None
+
+    def start(self):
+        # Returns the clients whose server isn't up after STARTUP_TIMEOUT, they
+        # stay supervised and are restarted in the background
+        taken = set()
+        for server in self.servers:
+            if server.client.is_server_running():
+                print(f"Reattaching to ComfyUI server on {server.client.server_address}")
+                server.reattached = True
+                taken.add(server.port)
+            else:
+                self.allocate_port(server, taken)
+                self.spawn(server)
+
+        self.monitor_thread = threading.Thread(target=self.monitor, daemon=True)
+        self.monitor_thread.start()
+
+        deadline = time.time() + STARTUP_TIMEOUT
+        return [
+            server.client
+            for server in self.servers
+            if not self.wait_until_ready(server, deadline)
+        ]
+
+    def wait_until_ready(self, server, deadline):
+        # Woken by the listener line in the server's output. Probing with
+        # exponential backoff covers reattached servers and output we don't
+        # recognise.
+        delay = PROBE_DELAY
+        while time.time() < deadline:
+            if server.reattached:
+                return True
+            woken = server.ready.wait(min(delay, max(deadline - time.time(), 0)))
+            if self.probe_ready(server):
+                return True
+            if server.process is not None and server.process.poll() is not None:
+                return False
+            if woken:
+                time.sleep(PROBE_DELAY)
+            else:
+                delay = min(delay * 2, MAX_PROBE_DELAY)
+        return False
+
+    def probe_ready(self, server):
+        if not server.client.is_server_running():
+            return False
+        with server.lock:
+            if server.started_at is None:
+                return True
+            now = time.time()
+            server.timeline["ready"] = now - server.started_at
+            record = self.startup_record(server)
+            server.started_at = None
+            server.restarts = 0
+        print(
+            f"✅ ComfyUI server on port {server.port} up after {record['stages']['comfyui_startup_total']:.2f}s"
+        )
+        print(f"ComfyUI startup timeline: {json.dumps(record)}")
+        if self.on_startup:
+            self.on_startup(record)
+        return True
+
+    def startup_record(self, server):
+        # Seconds spent in each boot phase, measured from the previous phase
+        # that was seen
+        stages = {}
+        previous = 0
+        for phase in [p for p, _ in STARTUP_MARKERS] + ["ready"]:
+            if phase in server.timeline:
+                stages[f"comfyui_{phase}"] = round(server.timeline[phase] - previous, 6)
+                previous = server.timeline[phase]
+        stages["comfyui_startup_total"] = round(server.timeline["ready"], 6)
+        return {
+            "request_id": f"comfyui-startup-{server.port}",
+            "started": server.started_at,
+            "event": "comfyui_startup",
+            "port": server.port,
+            "restart": server.restarts,
+            "custom_node_imports": dict(server.custom_node_imports),
+            "stages": stages,
+        }
+
+    def allocate_port(self, server, taken):
+        # Something other than ComfyUI holding the port moves us to the next
+        # free one. Ports in taken are already ours but may not be bound yet.
+        host, port = server.client.server_address.rsplit(":", 1)
+        port = int(port)
+        while port in taken or not self.port_free(host, port):
+            port += 1
+        taken.add(port)
+        if port != server.port:
+            print(f"Port {server.port} is taken, using {port}")
+            server.client.server_address = f"{host}:{port}"
+            server.client.http = HTTPClient(server.client.server_address)
+
+    @staticmethod
+    def port_free(host, port):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            return s.connect_ex((host, port)) != 0
+
+    def spawn(self, server):
+        # The node cache wrapper launches ComfyUI/main.py itself
+        main = "./helpers/comfyui_node_cache.py" if NODE_CACHE else "./ComfyUI/main.py"
+        command = [
+            sys.executable,
+            main,
+            "--port",
+            str(server.port),
+            "--output-directory",
+            self.output_directory,
+            "--input-directory",
+            self.input_directory,
+            "--disable-metadata",
+            "--preview-method",
+            "none",
+            "--gpu-only",
+        ]
+        if server.cuda_device is not None:
+            command += ["--cuda-device", server.cuda_device]
+
+        print(f"Starting ComfyUI server on port {server.port}")
+        with server.lock:
+            server.reattached = False
+            server.started_at = time.time()
+            server.ready.clear()
+            server.timeline = {}
+            server.custom_node_imports = {}
+        server.process = subprocess.Popen(
+            command,
+            # Unbuffered, so output lines arrive when they are printed
+            env={**os.environ, "PYTHONUNBUFFERED": "1"},
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=1,
+            text=True,
+            errors="replace",
+            start_new_session=True,
+        )
+        threading.Thread(
+            target=self.capture_output, args=(server, server.process), daemon=True
+        ).start()
+
+    def capture_output(self, server, process):
+        for line in process.stdout:
+            line = line.rstrip()
+            server.log.append(line)
+            print(f"[comfyui:{server.port}] {line}")
+            self.mark_startup(server, process, line)
+
+    def mark_startup(self, server, process, line):
+        with server.lock:
+            if server.started_at is None or process is not server.process:
+                return
+            elapsed = time.time() - server.started_at
+            for phase, marker in STARTUP_MARKERS:
+                if marker in line and phase not in server.timeline:
+                    server.timeline[phase] = elapsed
+            match = CUSTOM_NODE_IMPORT.match(line)
+            if match:
+                name = os.path.basename(match.group(3).strip())
+                if match.group(2):
+                    name += " (IMPORT FAILED)"
+                server.custom_node_imports[name] = float(match.group(1))
+            if "listener_ready" in server.timeline:
+                server.ready.set()
+
+    def kill(self, server):
+        if server.process is None:
+            return
+        try:
+            os.killpg(server.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        server.process.wait()
+
+    def monitor(self):
+        while True:
+            time.sleep(MONITOR_INTERVAL)
+            for server in self.servers:
+                try:
+                    self.check(server)
+                except Exception as e:
+                    print(f"ComfyUI supervisor check failed for port {server.port}: {e}")
+
+    def check(self, server):
+        client = server.client
+        if server.restart_at is not None:
+            if time.time() >= server.restart_at:
+                server.restart_at = None
+                self.spawn(server)
+                # Picks up the listener line as it arrives rather than on
+                # the next monitor pass
+                threading.Thread(
+                    target=self.wait_until_ready,
+                    args=(server, time.time() + STARTUP_TIMEOUT),
+                    daemon=True,
+                ).start()
+            return
+
+        if server.reattached:
+            # Not our process, we can only tell it is gone by probing
+            if client.is_server_running():
+                server.failed_probes = 0
+                return
+            server.failed_probes += 1
+            if server.failed_probes >= 3:
+                print(f"⚠️  ComfyUI server on port {server.port} went away")
+                self.restart(server, "ComfyUI server went away")
+            return
+
+        code = server.process.poll()
+        if code is not None:
+            print(f"⚠️  ComfyUI server on port {server.port} exited with code {code}")
+            print("\n".join(list(server.log)[-20:]))
+            self.restart(server, f"ComfyUI server exited with code {code}")
+            return
+
+        if server.started_at is not None:
+            elapsed = time.time() - server.started_at
+            if self.probe_ready(server):
+                return
+            if elapsed > STARTUP_TIMEOUT:
+                print(f"⚠️  ComfyUI server on port {server.port} did not start, killing it")
+                self.kill(server)
+                self.restart(server, "ComfyUI server did not start")
+            return
+
+        idle = time.time() - client.last_activity
+        if client.has_pending() and idle > HANG_TIMEOUT:
+            print(
+                f"⚠️  ComfyUI server on port {server.port} sent nothing for {idle:.0f}s, killing it"
+            )
+            self.kill(server)
+            self.restart(server, f"ComfyUI server hung for {idle:.0f}s")
+
+    def restart(self, server, reason):
+        # Prompts on the old process are lost, their waiters fail right away
+        # instead of blocking forever. Crash loops back off.
+        failed = server.client.fail_pending(RuntimeError(reason))
+        if failed:
+            print(f"Failed prompts {failed}")
+        delay = min(2**server.restarts, MAX_RESTART_DELAY)
+        server.restarts += 1
+        server.failed_probes = 0
+        server.started_at = None
+        server.restart_at = time.time() + delay
+        print(f"Restarting ComfyUI server on port {server.port} in {delay}s")
+
+    def stop(self):
+        for server in self.servers:
+            self.kill(server)
@@ -0,0 +1,101 @@
+import os
+import time
+import queue
+import threading
+import http.client
+from collections import deque
+
+HTTP_TIMEOUT = float(os.environ.get("COMFYUI_HTTP_TIMEOUT", 30))
+HTTP_RETRIES = int(os.environ.get("COMFYUI_HTTP_RETRIES", 2))
+HTTP_POOL_SIZE = 8
+
+# Latencies kept per endpoint for the report
+LATENCY_WINDOW = 1000
+
+
+class HTTPClient:
+    # Keep-alive connections to a single server, pooled across threads, with
+    # timeouts, retries and per endpoint latency tracking
+    def __init__(self, server_address, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES):
+        self.server_address = server_address
+        self.timeout = timeout
+        self.retries = retries
+        self.pool = queue.LifoQueue(maxsize=HTTP_POOL_SIZE)
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.pool.get_nowait(), True
+        except queue.Empty:
+            connection = http.client.HTTPConnection(
+                self.server_address, timeout=self.timeout
+            )
+            return connection, False
+
+    def release(self, connection, response):
+        if response.will_close:
+            connection.close()
+            return
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def request(self, method, path, body=None, headers=None, endpoint=None, retries=None):
+        # Returns (status, body). GETs are retried on any connection error.
+        # Other methods are only retried when a pooled connection turns out
+        # to have been closed by the server, so a prompt is never queued twice.
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            connection, reused = self.acquire()
+            start = time.time()
+            try:
+                connection.request(method, path, body, headers or {})
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                stale = reused and isinstance(
+                    e,
+                    (
+                        http.client.RemoteDisconnected,
+                        BrokenPipeError,
+                        ConnectionResetError,
+                    ),
+                )
+                if attempt == retries or (method != "GET" and not stale):
+                    raise
+                time.sleep(0 if stale else 0.1 * 2**attempt)
+                continue
+
+            self.release(connection, response)
+            self.record(f"{method} {endpoint or path}", time.time() - start)
+            return response.status, data
+
+    def record(self, endpoint, elapsed):
+        with self.lock:
+            if endpoint not in self.latencies:
+                self.latencies[endpoint] = deque(maxlen=LATENCY_WINDOW)
+            self.latencies[endpoint].append(elapsed)
+
+    def recent_latency(self, endpoint, window=20):
+        # Mean seconds over the last few requests, None before the first
+        with self.lock:
+            values = list(self.latencies.get(endpoint, []))[-window:]
+        return sum(values) / len(values) if values else None
+
+    def latency_report(self):
+        # Milliseconds per endpoint over the recent window
+        with self.lock:
+            latencies = {k: sorted(v) for k, v in self.latencies.items()}
+        return {
+            endpoint: {
+                "count": len(values),
+                "mean_ms": round(sum(values) / len(values) * 1000, 2),
+                "p50_ms": round(values[len(values) // 2] * 1000, 2),
+                "p95_ms": round(values[int(len(values) * 0.95)] * 1000, 2),
+            }
+            for endpoint, values in latencies.items()
+            if values
+        }
@@ -0,0 +1,180 @@
+import time
+import threading
+from collections import deque
+
+# Profiles kept per label for the rolling percentiles
+PROFILE_WINDOW = 200
+
+
+class PromptProfile:
+    # Per node timings for one prompt, built from the websocket events
+    # stamped with when our dispatcher received them
+    def __init__(self, prompt_id, workflow, queued_at=None):
+        self.prompt_id = prompt_id
+        self.workflow = workflow
+        self.queued_at = queued_at or time.time()
+        self.execution_start = None
+        self.finished = None
+        self.nodes = {}
+        self.current = None
+
+    def node(self, node_id):
+        if node_id not in self.nodes:
+            class_type = self.workflow.get(node_id, {}).get("class_type", "Unknown")
+            self.nodes[node_id] = {
+                "class_type": class_type,
+                "start": None,
+                "end": None,
+                "cached": False,
+                "steps": None,
+            }
+        return self.nodes[node_id]
+
+    def record(self, message):
+        at = message.get("received_at", time.time())
+        data = message.get("data") or {}
+        kind = message["type"]
+
+        if kind == "execution_start":
+            self.execution_start = at
+        elif kind == "execution_cached":
+            # ComfyUI reused these from the previous prompt
+            for node_id in data.get("nodes", []):
+                self.node(node_id)["cached"] = "comfyui"
+        elif kind == "node_cache_hit":
+            self.node(data["node"])["cached"] = "node_cache"
+        elif kind == "executing":
+            # A node runs from its executing event until the next one
+            if self.execution_start is None:
+                self.execution_start = at
+            self.close_current(at)
+            if data["node"] is None:
+                self.finished = at
+            else:
+                self.current = data["node"]
+                self.node(self.current)["start"] = at
+        elif kind == "executed":
+            node = self.node(data["node"])
+            if node["end"] is None and node["start"] is not None:
+                node["end"] = at
+        elif kind == "progress" and self.current is not None:
+            self.node(self.current)["steps"] = data.get("max")
+
+    def close_current(self, at):
+        if self.current is not None:
+            node = self.nodes[self.current]
+            if node["end"] is None:
+                node["end"] = at
+            self.current = None
+
+    def node_durations(self):
+        return {
+            node_id: node["end"] - node["start"]
+            for node_id, node in self.nodes.items()
+            if node["start"] is not None and node["end"] is not None
+        }
+
+    def class_type_durations(self):
+        durations = {}
+        for node_id, duration in self.node_durations().items():
+            class_type = self.nodes[node_id]["class_type"]
+            durations[class_type] = durations.get(class_type, 0) + duration
+        return durations
+
+    def summary(self):
+        return {
+            "prompt_id": self.prompt_id,
+            "queue_wait": round(self.execution_start - self.queued_at, 4)
+            if self.execution_start
+            else None,
+            "execution": round(self.finished - self.execution_start, 4)
+            if self.finished and self.execution_start
+            else None,
+            "nodes": {
+                node_id: {
+                    "class_type": self.nodes[node_id]["class_type"],
+                    "duration": round(duration, 4),
+                    "steps": self.nodes[node_id]["steps"],
+                }
+                for node_id, duration in self.node_durations().items()
+            },
+            "cached": {n: node["cached"] for n, node in self.nodes.items() if node["cached"]},
+            "class_types": {
+                class_type: round(duration, 4)
+                for class_type, duration in self.class_type_durations().items()
+            },
+        }
+
+
+class RollingPercentiles:
+    # Class type durations over the last PROFILE_WINDOW profiles per label,
+    # e.g. per number_of_images
+    def __init__(self, window=PROFILE_WINDOW):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def add(self, profile, label=None):
+        with self.lock:
+            for class_type, duration in profile.class_type_durations().items():
+                key = (label, class_type)
+                if key not in self.samples:
+                    self.samples[key] = deque(maxlen=self.window)
+                self.samples[key].append(duration)
+
+    def percentiles(self, label=None):
+        with self.lock:
+            samples = {
+                class_type: sorted(values)
+                for (sample_label, class_type), values in self.samples.items()
+                if sample_label == label
+            }
+
+        report = {}
+        for class_type, values in samples.items():
+            report[class_type] = {
+                "count": len(values),
+                "p50": round(values[len(values) // 2], 4),
+                "p90": round(values[int(len(values) * 0.9)], 4),
+                "p99": round(values[int(len(values) * 0.99)], 4),
+            }
+        return report
+
+
+class CacheHitRatios:
+    # How often each node class is served from a cache rather than run,
+    # cumulatively and over the last PROFILE_WINDOW prompts
+    def __init__(self, window=PROFILE_WINDOW):
+        self.window = window
+        self.totals = {}
+        self.recent = {}
+        self.lock = threading.Lock()
+
+    def add(self, profile):
+        with self.lock:
+            for node in profile.nodes.values():
+                class_type = node["class_type"]
+                totals = self.totals.setdefault(
+                    class_type, {"runs": 0, "comfyui": 0, "node_cache": 0}
+                )
+                totals["runs"] += 1
+                if node["cached"]:
+                    totals[node["cached"]] += 1
+                if class_type not in self.recent:
+                    self.recent[class_type] = deque(maxlen=self.window)
+                self.recent[class_type].append(bool(node["cached"]))
+
+    def ratios(self):
+        with self.lock:
+            return {
+                class_type: {
+                    **totals,
+                    "hit_ratio": round(
+                        (totals["comfyui"] + totals["node_cache"]) / totals["runs"], 4
+                    ),
+                    "recent_hit_ratio": round(
+                        sum(self.recent[class_type]) / len(self.recent[class_type]), 4
+                    ),
+                }
+                for class_type, totals in self.totals.items()
+            }
@@ -0,0 +1,116 @@
+import io
+import threading
+from PIL import Image
+from PIL.JpegImagePlugin import JpegImageFile
+
+EXIF_ORIENTATION = 0x0112
+
+# Modes Image.reduce handles, anything else (16-bit PNGs, for one) is left at
+# full size for the workflow's own resize
+REDUCIBLE_MODES = ["L", "LA", "RGB", "RGBA", "RGBX", "CMYK", "I", "F"]
+
+# Magic bytes at the start of each supported format
+SIGNATURES = [
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+]
+
+
+def sniff_format(header):
+    for signature, extension in SIGNATURES:
+        if header.startswith(signature):
+            return extension
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
+
+class InputImage:
+    # An ingested input: the bytes handed to ComfyUI plus the decoded RGB
+    # pixels, decoded at most once and shared by every later stage
+    def __init__(self, data, extension, image=None):
+        self.data = data
+        self.extension = extension
+        self.filename = None
+        self._image = image
+        self._lock = threading.Lock()
+
+    @property
+    def pixels(self):
+        with self._lock:
+            if self._image is None:
+                self._image = Image.open(io.BytesIO(self.data))
+            if self._image.mode != "RGB":
+                self._image = self._image.convert("RGB")
+            return self._image
+
+
+def read_input_file(input_file, max_size=None):
+    # Returns an InputImage ready to hand to ComfyUI. Images are only
+    # re-encoded when a JPEG has to be rotated to honour its EXIF
+    # orientation, or when they are at least twice max_size on their longest
+    # side and can be cheaply shrunk towards it while decoding.
+    with open(input_file, "rb") as f:
+        data = f.read()
+
+    file_extension = sniff_format(data[:12])
+    if file_extension is None:
+        raise ValueError(f"Unsupported file type: {input_file}")
+
+    # Opening only parses headers, the pixels are not decoded yet
+    image = Image.open(io.BytesIO(data))
+    orientation = 1
+    if file_extension == ".jpg":
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+
+    needs_rotation = orientation in range(2, 9)
+    needs_resize = (
+        max_size is not None
+        and max(image.size) >= max_size * 2
+        and image.mode in REDUCIBLE_MODES + ["P"]
+    )
+    if not needs_rotation and not needs_resize:
+        return InputImage(data, file_extension)
+
+    if needs_resize:
+        image = downscale(image, max_size)
+
+    if needs_rotation:
+        image = image.transpose(
+            {
+                2: Image.Transpose.FLIP_LEFT_RIGHT,
+                3: Image.Transpose.ROTATE_180,
+                4: Image.Transpose.FLIP_TOP_BOTTOM,
+                5: Image.Transpose.TRANSPOSE,
+                6: Image.Transpose.ROTATE_270,
+                7: Image.Transpose.TRANSVERSE,
+                8: Image.Transpose.ROTATE_90,
+            }[orientation]
+        )
+
+    # Lowest zlib level, the output is a short lived hand-off file
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return InputImage(buffer.getvalue(), ".png", image)
+
+
+def downscale(image, max_size):
+    # Shrinks by whole factors only, so the longest side never drops below
+    # max_size and the workflow's own resize still has the final say
+    width, height = image.size
+    scale = max_size / max(width, height)
+
+    # Includes MPO, the multi-picture JPEGs some phone cameras produce
+    if isinstance(image, JpegImageFile):
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale instead of full size
+        image.draft(image.mode, (round(width * scale), round(height * scale)))
+
+    factor = max(image.size) // max_size
+    if factor >= 2:
+        if image.mode == "P":
+            image = image.convert("RGBA")
+        if image.mode not in REDUCIBLE_MODES:
+            return image
+        # Box reduction, much cheaper than a resampling resize
+        image = image.reduce(factor)
+    return image
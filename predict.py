@@ -1,79 +1,190 @@
 import os
+import uuid
 import shutil
+import hashlib
 import random
 import json
-from PIL import Image, ExifTags
+import time
+import threading
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from safety_checker import SafetyChecker
-from typing import List
+from input_files import read_input_file
+from preprocess_cache import PreprocessCache
+from scratch import Scratch, ScratchReaper
+from stage_timings import SetupSteps, StageTimer, TimingSink
+from typing import Iterator, List
 from cog import BasePredictor, Input, Path
 from helpers.comfyui import ComfyUI
+from helpers.comfyui_pool import ComfyUIPool
+from helpers.prompt_profile import RollingPercentiles
 
 OUTPUT_DIR = "/tmp/outputs"
 INPUT_DIR = "/tmp/inputs"
 COMFYUI_TEMP_OUTPUT_DIR = "ComfyUI/temp"
 
+# Subfolder of INPUT_DIR for staged inputs, named by their content and swept
+# by the reaper once unused
+CONTENT_INPUTS = "inputs"
+
+# Subfolder of OUTPUT_DIR the workflow saves new cache entries into
+PREPROCESS_CACHE_OUTPUT = "preprocess_cache"
+
+# How inputs reach ComfyUI:
+# - "filesystem" writes them into INPUT_DIR, which the server shares with us
+# - "upload" pushes them from memory to the server's /upload/image endpoint
+INPUT_TRANSPORT = os.environ.get("COMFYUI_INPUT_TRANSPORT", "filesystem")
+
+# Comma separated host:port list. With more than one, prompts are spread over
+# the servers by queue depth. Servers not on this host must already be running
+# and need COMFYUI_INPUT_TRANSPORT=upload
+COMFYUI_SERVERS = os.environ.get("COMFYUI_SERVERS", "127.0.0.1:8188").split(",")
+
 with open("become-image-api.json", "r") as file:
     workflow_json = file.read()
 
+# Node 67 resizes the face to fit this anyway, so larger inputs are shrunk
+# towards it while decoding
+resize_inputs = json.loads(workflow_json)["67"]["inputs"]
+MAX_INPUT_SIZE = max(resize_inputs["width"], resize_inputs["height"])
+
+# Mirrors the defaults of Predictor.predict, used to fill in parameters for
+# the other prediction modes and per-pair overrides
+DEFAULT_PARAMETERS = {
+    "prompt": "a person",
+    "negative_prompt": "",
+    "number_of_images": 2,
+    "denoising_strength": 1,
+    "prompt_strength": 2.0,
+    "control_depth_strength": 0.8,
+    "instant_id_strength": 1,
+    "image_to_become_strength": 0.75,
+    "image_to_become_noise": 0.3,
+    "seed": None,
+}
+
 
 class Predictor(BasePredictor):
     def setup(self):
-        self.safetyChecker = SafetyChecker()
-        self.comfyUI = ComfyUI("127.0.0.1:8188")
-        self.comfyUI.start_server(OUTPUT_DIR, INPUT_DIR)
-        self.comfyUI.load_workflow(workflow_json, check_inputs=False)
-
-    def cleanup(self):
-        self.comfyUI.clear_queue()
-        for directory in [OUTPUT_DIR, INPUT_DIR, COMFYUI_TEMP_OUTPUT_DIR]:
+        steps = SetupSteps()
+        self.safety_lock = threading.Lock()
+        self.preprocess_cache = PreprocessCache()
+        self.node_timings = RollingPercentiles()
+        self.timing_sink = TimingSink()
+
+        # Requests with the safety checker disabled never wait for it
+        self.safety_checker_future = steps.add(
+            "safety_checker", SafetyChecker, background=True
+        )
+        steps.add("prepare_directories", self.prepare_directories)
+        steps.add("comfyui_client", self.create_comfyui_client)
+        steps.add(
+            "start_server",
+            self.start_server,
+            after=["comfyui_client", "prepare_directories"],
+        )
+        # Weights are only read when a prompt runs, so they download while
+        # the server boots
+        steps.add(
+            "workflow_weights",
+            lambda: self.comfyUI.load_workflow(workflow_json, check_inputs=False),
+            after=["comfyui_client"],
+        )
+        steps.wait()
+        self.reaper = ScratchReaper(
+            sweep_directories=[
+                COMFYUI_TEMP_OUTPUT_DIR,
+                os.path.join(INPUT_DIR, CONTENT_INPUTS),
+            ]
+        )
+
+        record = steps.record()
+        print(f"Setup critical path: {' -> '.join(record['critical_path'])}")
+        print(f"Setup took {record['stages']['setup_total']:.2f}s")
+        self.timing_sink.write(record)
+
+    @property
+    def safetyChecker(self):
+        # Loaded in the background during setup, first use waits for it
+        return self.safety_checker_future.result()
+
+    def check_safety(self, images, raise_if_all_nsfw=True):
+        # The checker is shared by every thread a prediction can run in, so
+        # all calls go through here one at a time
+        with self.safety_lock:
+            return self.safetyChecker.run(images, raise_if_all_nsfw=raise_if_all_nsfw)
+
+    def prepare_directories(self):
+        # Leftovers from a previous container are cleared once, requests then
+        # get their own subdirectories which the reaper deletes
+        for directory in [OUTPUT_DIR, INPUT_DIR]:
             if os.path.exists(directory):
                 shutil.rmtree(directory)
             os.makedirs(directory)
+        os.makedirs(os.path.join(INPUT_DIR, CONTENT_INPUTS))
 
-    def handle_input_file(self, input_file: Path, filename: str):
-        file_extension = os.path.splitext(input_file)[1].lower()
-        if file_extension in [".jpg", ".jpeg"]:
-            final_filename = f"{filename}.png"
-            image = Image.open(input_file)
-
-            try:
-                for orientation in ExifTags.TAGS.keys():
-                    if ExifTags.TAGS[orientation] == "Orientation":
-                        break
-                exif = dict(image._getexif().items())
-
-                if exif[orientation] == 3:
-                    image = image.rotate(180, expand=True)
-                elif exif[orientation] == 6:
-                    image = image.rotate(270, expand=True)
-                elif exif[orientation] == 8:
-                    image = image.rotate(90, expand=True)
-            except (KeyError, AttributeError):
-                # EXIF data does not have orientation
-                # Do not rotate
-                pass
-
-            image.save(os.path.join(INPUT_DIR, final_filename))
-        elif file_extension in [".png", ".webp"]:
-            final_filename = filename + file_extension
-            shutil.copy(input_file, os.path.join(INPUT_DIR, final_filename))
+    def create_comfyui_client(self):
+        if len(COMFYUI_SERVERS) > 1:
+            self.comfyUI = ComfyUIPool(COMFYUI_SERVERS)
         else:
-            raise ValueError(f"Unsupported file type: {file_extension}")
-
-        return final_filename
-
-    def log_and_collect_files(self, directory, prefix=""):
-        files = []
-        for f in os.listdir(directory):
-            if f == "__MACOSX":
-                continue
-            path = os.path.join(directory, f)
-            if os.path.isfile(path):
-                print(f"{prefix}{f}")
-                files.append(Path(path))
-            elif os.path.isdir(path):
-                print(f"{prefix}{f}/")
-                files.extend(self.log_and_collect_files(path, prefix=f"{prefix}{f}/"))
+            self.comfyUI = ComfyUI(COMFYUI_SERVERS[0])
+
+    def start_server(self):
+        # Startup timelines land next to the prediction timings, restarts too
+        self.comfyUI.start_server(
+            OUTPUT_DIR, INPUT_DIR, on_startup=self.timing_sink.write
+        )
+
+    def start_timing(self):
+        # Every prediction, whatever its mode, leaves one timing record
+        timer = StageTimer(None)
+        with timer.stage("create_scratch"):
+            scratch = Scratch(OUTPUT_DIR)
+        timer.request_id = scratch.id
+        return timer, scratch
+
+    def write_timing(self, timer, **extra):
+        record = timer.record(**extra)
+        print(f"Stage timings: {record['stages']}")
+        self.timing_sink.write(record)
+
+    def handle_input_file(self, scratch: Scratch, input_file: Path, filename: str):
+        # Returns the ingested InputImage, with the name ComfyUI knows it by
+        input_image = read_input_file(input_file, MAX_INPUT_SIZE)
+        input_image.filename = self.stage_input(
+            scratch, filename + input_image.extension, input_image.data
+        )
+        return input_image
+
+    def stage_input(self, scratch: Scratch, filename, data):
+        # Named by content, so the same image has the same name in every
+        # request and the caches downstream of LoadImage can match it
+        extension = os.path.splitext(filename)[1]
+        name = hashlib.sha256(data).hexdigest() + extension
+        if INPUT_TRANSPORT == "upload":
+            return self.comfyUI.upload_image(name, data, subfolder=CONTENT_INPUTS)
+
+        path = os.path.join(INPUT_DIR, CONTENT_INPUTS, name)
+        # Pinned before the existence check, so the sweep can't remove it
+        # between the two. It stays pinned until the request is released.
+        self.reaper.pin(scratch, path)
+        if not os.path.exists(path):
+            staging = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(staging, "wb") as f:
+                f.write(data)
+            os.replace(staging, path)
+        return f"{CONTENT_INPUTS}/{name}"
+
+    def collect_outputs(self, prompt_id, outputs, destination):
+        # Only the images SaveImage reported for this prompt, not whatever
+        # happens to be in the output directory
+        server = self.comfyUI.server_for(prompt_id)
+        files = [
+            Path(f) for f in server.collect_outputs(outputs, destination, node_id="5")
+        ]
+        for f in files:
+            print(f.name)
         return files
 
     def update_workflow(self, workflow, **kwargs):
@@ -114,6 +225,591 @@ class Predictor(BasePredictor):
         batcher = workflow["85"]["inputs"]
         batcher["multiply_by"] = kwargs["number_of_images"]
 
+        if kwargs.get("filename_prefix"):
+            workflow["5"]["inputs"]["filename_prefix"] = kwargs["filename_prefix"]
+
+    def check_inputs_provided(self, image, image_to_become):
+        if image is None or image_to_become is None:
+            missing_images = []
+            if image is None:
+                missing_images.append("image")
+            if image_to_become is None:
+                missing_images.append("image_to_become")
+            raise ValueError(f"No {' and '.join(missing_images)} provided")
+
+    def apply_preprocess_cache(self, workflow, face, scratch):
+        # The depth map (node 49) and VAE encode (node 51) only depend on the
+        # face image, so are served from the cache or saved into it. InstantID
+        # face analysis and the IPAdapter CLIP vision encoding run inside
+        # ApplyInstantID and IPAdapterApply, and can't be split out.
+        cache = self.preprocess_cache
+        resize = workflow["67"]["inputs"]
+
+        depth = workflow["49"]["inputs"]
+        depth_key = cache.key(
+            "depth",
+            face.data,
+            resize=resize,
+            preprocessor=depth["preprocessor"],
+            resolution=depth["resolution"],
+        )
+        cached = cache.get(depth_key, ".png")
+        if cached:
+            with open(cached, "rb") as f:
+                name = self.stage_input(scratch, f"{depth_key}.png", f.read())
+            workflow["49"] = {
+                "inputs": {"image": name, "upload": "image"},
+                "class_type": "LoadImage",
+                "_meta": {"title": "Cached depth map"},
+            }
+        else:
+            workflow["cache_depth"] = {
+                "inputs": {
+                    "images": ["49", 0],
+                    "filename_prefix": scratch.name(f"{PREPROCESS_CACHE_OUTPUT}/{depth_key}"),
+                },
+                "class_type": "SaveImage",
+                "_meta": {"title": "Cache depth map"},
+            }
+
+        loader = workflow["2"]["inputs"]
+        latent_key = cache.key(
+            "latent",
+            face.data,
+            resize=resize,
+            ckpt_name=loader["ckpt_name"],
+            vae_name=loader["vae_name"],
+        )
+        cached = cache.get(latent_key, ".latent")
+        if cached:
+            with open(cached, "rb") as f:
+                name = self.stage_input(scratch, f"{latent_key}.latent", f.read())
+            workflow["cache_latent"] = {
+                "inputs": {"latent": name},
+                "class_type": "LoadLatent",
+                "_meta": {"title": "Cached VAE encode"},
+            }
+        else:
+            # Encode the single resized face rather than the duplicated batch
+            workflow["cache_latent"] = {
+                "inputs": {"pixels": ["67", 0], "vae": ["2", 4]},
+                "class_type": "VAEEncode",
+                "_meta": {"title": "VAE Encode"},
+            }
+            workflow["cache_latent_save"] = {
+                "inputs": {
+                    "samples": ["cache_latent", 0],
+                    "filename_prefix": scratch.name(
+                        f"{PREPROCESS_CACHE_OUTPUT}/{latent_key}"
+                    ),
+                },
+                "class_type": "SaveLatent",
+                "_meta": {"title": "Cache VAE encode"},
+            }
+
+        workflow["51"] = {
+            "inputs": {
+                "samples": ["cache_latent", 0],
+                "amount": workflow["85"]["inputs"]["multiply_by"],
+            },
+            "class_type": "RepeatLatentBatch",
+            "_meta": {"title": "Repeat Latent Batch"},
+        }
+
+        print(f"Preprocess cache: {cache.hit_rates()}")
+
+    def harvest_preprocess_cache(self, scratch):
+        if self.preprocess_cache.enabled:
+            self.preprocess_cache.harvest(
+                os.path.join(scratch.output_dir, PREPROCESS_CACHE_OUTPUT)
+            )
+
+    def build_workflow(
+        self,
+        scratch,
+        filename,
+        image_to_become_filename,
+        face=None,
+        timer=None,
+        **kwargs,
+    ):
+        def stage(name):
+            return timer.stage(name) if timer else nullcontext()
+
+        kwargs.setdefault("filename_prefix", scratch.name("ComfyUI"))
+        if kwargs["seed"] is None:
+            kwargs["seed"] = random.randint(0, 2**32 - 1)
+            print(f"Random seed set to: {kwargs['seed']}")
+
+        with stage("update_workflow"):
+            workflow = json.loads(workflow_json)
+            self.update_workflow(
+                workflow,
+                filename=filename,
+                image_to_become_filename=image_to_become_filename,
+                **kwargs,
+            )
+        if face is not None and self.preprocess_cache.enabled:
+            with stage("preprocess_cache"):
+                self.apply_preprocess_cache(workflow, face, scratch)
+        with stage("load_workflow"):
+            return self.comfyUI.load_workflow(workflow, check_weights=False)
+
+    def make_job(self, scratch, index, pair, **kwargs):
+        # A pair is a dict with "image", "image_to_become" and any predict
+        # parameters to override. Everything else falls back to kwargs, then
+        # DEFAULT_PARAMETERS.
+        pair = dict(pair)
+        image = pair.pop("image", None)
+        image_to_become = pair.pop("image_to_become", None)
+        self.check_inputs_provided(image, image_to_become)
+
+        unknown = set(pair) - set(DEFAULT_PARAMETERS)
+        if unknown:
+            raise ValueError(f"Unknown parameters for pair {index}: {sorted(unknown)}")
+
+        face = self.handle_input_file(scratch, image, f"pair_{index}_image_of_face")
+        to_become = self.handle_input_file(
+            scratch, image_to_become, f"pair_{index}_image_to_become"
+        )
+        return {
+            "scratch": scratch,
+            "index": index,
+            "inputs": [face, to_become],
+            "filename": face.filename,
+            "image_to_become_filename": to_become.filename,
+            "params": {**DEFAULT_PARAMETERS, **kwargs, **pair},
+            "prefix": f"pair_{index}",
+        }
+
+    def build_job_workflow(self, job, timer=None):
+        scratch = job["scratch"]
+        job["workflow"] = self.build_workflow(
+            scratch,
+            job["filename"],
+            job["image_to_become_filename"],
+            face=job["inputs"][0],
+            timer=timer,
+            filename_prefix=scratch.name(f"{job['prefix']}/ComfyUI"),
+            **job["params"],
+        )
+        return job
+
+    def collect_job_outputs(self, job, disable_safety_checker=False):
+        if job.get("skip") or "prompt_id" not in job:
+            return []
+
+        print(f"Outputs of pair {job['index']}:")
+        directory = os.path.join(job["scratch"].output_dir, job["prefix"])
+        prompt_id = job["prompt_id"]
+        files = self.collect_outputs(
+            prompt_id, self.comfyUI.get_history(prompt_id), directory
+        )
+        if not disable_safety_checker and files:
+            # A fully flagged pair comes back empty, the rest of the batch
+            # still gets its outputs
+            has_nsfw_content = self.check_safety(files, raise_if_all_nsfw=False)
+            if any(has_nsfw_content):
+                print(f"Removing NSFW images from pair {job['index']}")
+                files = [f for i, f in enumerate(files) if not has_nsfw_content[i]]
+        return files
+
+    def predict_batch(self, pairs, disable_safety_checker=False, **kwargs):
+        """Run many (image, image_to_become) pairs, returning outputs per pair"""
+        if not pairs:
+            return []
+        timer, scratch = self.start_timing()
+        status = "error"
+        results = []
+        try:
+            results = self.run_batch(
+                scratch, timer, pairs, disable_safety_checker, **kwargs
+            )
+            status = "ok"
+            return results
+        finally:
+            self.reaper.release(scratch)
+            self.write_timing(
+                timer,
+                status=status,
+                mode="batch",
+                pairs=len(pairs),
+                number_of_images=sum(len(files) for files in results),
+            )
+
+    def run_batch(self, scratch, timer, pairs, disable_safety_checker, **kwargs):
+        with timer.stage("handle_input_file"):
+            jobs = [
+                self.make_job(scratch, i, pair, **kwargs)
+                for i, pair in enumerate(pairs)
+            ]
+
+        if not disable_safety_checker:
+            # One safety check pass over every input image
+            input_images = [i.pixels for job in jobs for i in job["inputs"]]
+            with timer.stage("input_safety_check"):
+                has_nsfw_content_input = self.check_safety(
+                    input_images, raise_if_all_nsfw=False
+                )
+            for i, job in enumerate(jobs):
+                if any(has_nsfw_content_input[i * 2 : i * 2 + 2]):
+                    print(f"NSFW content detected in input images of pair {i}, skipping")
+                    job["skip"] = True
+
+        jobs_to_run = [
+            self.build_job_workflow(job, timer) for job in jobs if not job.get("skip")
+        ]
+
+        with timer.stage("connect"):
+            self.comfyUI.connect()
+        with timer.stage("execution"):
+            prompt_ids = self.comfyUI.run_workflows(
+                [job["workflow"] for job in jobs_to_run]
+            )
+        for job, prompt_id in zip(jobs_to_run, prompt_ids):
+            job["prompt_id"] = prompt_id
+        self.harvest_preprocess_cache(scratch)
+
+        with timer.stage("collect_outputs"):
+            return [
+                self.collect_job_outputs(job, disable_safety_checker) for job in jobs
+            ]
+
+    def prepare_pipelined_job(
+        self, scratch, index, pair, disable_safety_checker, **kwargs
+    ):
+        # CPU side of a pipelined request: ingestion, input safety check and
+        # workflow rewrite, run in the worker pool ahead of the GPU stage
+        job = self.make_job(scratch, index, pair, **kwargs)
+        if not disable_safety_checker:
+            has_nsfw_content_input = self.check_safety(
+                [i.pixels for i in job["inputs"]], raise_if_all_nsfw=False
+            )
+            if any(has_nsfw_content_input):
+                print(f"NSFW content detected in input images of pair {index}, skipping")
+                job["skip"] = True
+                return job
+        return self.build_job_workflow(job)
+
+    def predict_pipelined(
+        self,
+        pairs,
+        prefetch=2,
+        workers=2,
+        queue_depth=2,
+        disable_safety_checker=False,
+        **kwargs,
+    ):
+        """Run pairs with CPU stages overlapped with GPU execution"""
+        # Up to `prefetch` pairs are ingested and checked ahead of the GPU,
+        # and up to `queue_depth` prompts sit on the ComfyUI queue so the
+        # server goes straight from one prompt to the next
+        if not pairs:
+            return []
+        timer, scratch = self.start_timing()
+        status = "error"
+        results = []
+        try:
+            results = self.run_pipelined(
+                scratch,
+                timer,
+                pairs,
+                prefetch,
+                workers,
+                queue_depth,
+                disable_safety_checker,
+                **kwargs,
+            )
+            status = "ok"
+            return results
+        finally:
+            self.reaper.release(scratch)
+            self.write_timing(
+                timer,
+                status=status,
+                mode="pipelined",
+                pairs=len(pairs),
+                number_of_images=sum(len(files) for files in results),
+            )
+
+    def run_pipelined(
+        self,
+        scratch,
+        timer,
+        pairs,
+        prefetch,
+        workers,
+        queue_depth,
+        disable_safety_checker,
+        **kwargs,
+    ):
+        # Stages time the main loop only, the worker pool overlaps with it,
+        # so they show where the GPU side waited
+        with timer.stage("connect"):
+            self.comfyUI.connect()
+
+        start = time.time()
+        results = [None] * len(pairs)
+        pending = iter(enumerate(pairs))
+        prepared = deque()
+        in_flight = deque()
+        collecting = []
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+
+            def prefetch_jobs():
+                while len(prepared) < prefetch:
+                    try:
+                        i, pair = next(pending)
+                    except StopIteration:
+                        return
+                    prepared.append(
+                        pool.submit(
+                            self.prepare_pipelined_job,
+                            scratch,
+                            i,
+                            pair,
+                            disable_safety_checker,
+                            **kwargs,
+                        )
+                    )
+
+            prefetch_jobs()
+            try:
+                while prepared or in_flight:
+                    while prepared and len(in_flight) < queue_depth:
+                        with timer.stage("prepare_wait"):
+                            job = prepared.popleft().result()
+                        prefetch_jobs()
+                        if job.get("skip"):
+                            results[job["index"]] = []
+                            continue
+                        with timer.stage("queue_prompt"):
+                            job["prompt_id"] = self.comfyUI.queue_prompt(
+                                job["workflow"]
+                            )
+                        in_flight.append(job)
+
+                    if in_flight:
+                        job = in_flight.popleft()
+                        with timer.stage("execution"):
+                            self.comfyUI.wait_for_prompt_completion(
+                                job["workflow"], job["prompt_id"]
+                            )
+                        collecting.append(
+                            (
+                                job["index"],
+                                pool.submit(
+                                    self.collect_job_outputs, job, disable_safety_checker
+                                ),
+                            )
+                        )
+            finally:
+                # Only left over when something failed, our prompts shouldn't
+                # keep the GPU busy
+                self.comfyUI.cancel(*[job["prompt_id"] for job in in_flight])
+
+            with timer.stage("collect_outputs"):
+                for index, future in collecting:
+                    results[index] = future.result()
+
+        # Only once the queue has drained, so no entry is still being written
+        self.harvest_preprocess_cache(scratch)
+
+        elapsed = time.time() - start
+        total_images = sum(len(files) for files in results)
+        print(
+            f"Pipelined {len(pairs)} pairs, {total_images} images in {elapsed:.2f}s ({total_images / elapsed:.2f} images/sec)"
+        )
+        return results
+
+    def predict_stream(
+        self, image, image_to_become, disable_safety_checker=False, **kwargs
+    ) -> Iterator[Path]:
+        """Run a prediction, yielding each image as soon as it is saved"""
+        timer, scratch = self.start_timing()
+        status = "error"
+        streamed = 0
+        try:
+            for path in self.run_stream(
+                scratch, timer, image, image_to_become, disable_safety_checker, **kwargs
+            ):
+                if not streamed:
+                    timer.add("first_output", time.time() - timer.started)
+                streamed += 1
+                yield path
+            status = "ok"
+        except GeneratorExit:
+            status = "cancelled"
+            raise
+        finally:
+            self.reaper.release(scratch)
+            self.write_timing(
+                timer, status=status, mode="stream", number_of_images=streamed
+            )
+
+    def run_stream(
+        self, scratch, timer, image, image_to_become, disable_safety_checker, **kwargs
+    ):
+        self.check_inputs_provided(image, image_to_become)
+
+        with timer.stage("handle_input_file"):
+            face = self.handle_input_file(scratch, image, "image_of_face")
+            to_become = self.handle_input_file(
+                scratch, image_to_become, "image_to_become"
+            )
+
+        if not disable_safety_checker:
+            with timer.stage("input_safety_check"):
+                has_nsfw_content_input = self.check_safety(
+                    [face.pixels, to_become.pixels]
+                )
+            if any(has_nsfw_content_input):
+                raise ValueError("NSFW content detected in input images")
+
+        params = {**DEFAULT_PARAMETERS, **kwargs}
+        if params["seed"] is None:
+            params["seed"] = random.randint(0, 2**32 - 1)
+            print(f"Random seed set to: {params['seed']}")
+
+        # SaveImage reports a whole batch in a single executed event, so queue
+        # one single-image prompt per output, with consecutive seeds, to get
+        # each image back as soon as it lands
+        workflows = [
+            self.build_workflow(
+                scratch,
+                face.filename,
+                to_become.filename,
+                face=face,
+                timer=timer,
+                **{**params, "number_of_images": 1, "seed": params["seed"] + i},
+            )
+            for i in range(params["number_of_images"])
+        ]
+
+        with timer.stage("connect"):
+            self.comfyUI.connect()
+        prompt_ids = []
+        try:
+            with timer.stage("queue_prompt"):
+                for wf in workflows:
+                    prompt_ids.append(self.comfyUI.queue_prompt(wf))
+
+            for wf, prompt_id in zip(workflows, prompt_ids):
+                server = self.comfyUI.server_for(prompt_id)
+                for output in self.comfyUI.iter_prompt_outputs(wf, prompt_id, node_id="5"):
+                    path = Path(server.fetch_output(output, scratch.output_dir))
+                    if not disable_safety_checker:
+                        with timer.stage("output_safety_check"):
+                            has_nsfw_content = self.check_safety(
+                                [path], raise_if_all_nsfw=False
+                            )
+                        if has_nsfw_content[0]:
+                            print(f"Removing NSFW image {output['filename']}")
+                            continue
+                    print(f"Streaming {output['filename']}")
+                    yield path
+        finally:
+            # Anything still queued if the caller stopped consuming early
+            self.comfyUI.cancel(*prompt_ids)
+
+        self.harvest_preprocess_cache(scratch)
+
+    def batch_pairs(
+        self, image, image_to_become, extra_images, extra_images_to_become
+    ):
+        extra_images = extra_images or []
+        extra_images_to_become = extra_images_to_become or []
+        if len(extra_images) != len(extra_images_to_become):
+            raise ValueError(
+                "extra_images and extra_images_to_become need the same number of images"
+            )
+        return [{"image": image, "image_to_become": image_to_become}] + [
+            {"image": a, "image_to_become": b}
+            for a, b in zip(extra_images, extra_images_to_become)
+        ]
+
+    def predict_single(
+        self, image, image_to_become, disable_safety_checker=False, **kwargs
+    ):
+        """Run a prediction, returning its images once they are all done"""
+        params = {**DEFAULT_PARAMETERS, **kwargs}
+        number_of_images = params["number_of_images"]
+        timer, scratch = self.start_timing()
+        status = "error"
+        # Per node timings of the prompt, so slow predictions can be traced
+        # to the nodes that made them slow
+        node_profile = {"nodes": {}, "class_types": {}, "cached_nodes": {}}
+        try:
+            self.check_inputs_provided(image, image_to_become)
+
+            with timer.stage("handle_input_file"):
+                face = self.handle_input_file(scratch, image, "image_of_face")
+                to_become = self.handle_input_file(
+                    scratch, image_to_become, "image_to_become"
+                )
+
+            if not disable_safety_checker:
+                with timer.stage("input_safety_check"):
+                    has_nsfw_content_input = self.check_safety(
+                        [face.pixels, to_become.pixels]
+                    )
+                if any(has_nsfw_content_input):
+                    raise ValueError("NSFW content detected in input images")
+
+            wf = self.build_workflow(
+                scratch,
+                face.filename,
+                to_become.filename,
+                face=face,
+                timer=timer,
+                **params,
+            )
+
+            with timer.stage("connect"):
+                self.comfyUI.connect()
+            prompt_id, outputs = self.comfyUI.run_workflow(wf, timer=timer)
+            profile = self.comfyUI.get_profile(prompt_id)
+            if profile is not None:
+                # Split the wait into time queued behind other prompts, before
+                # the first executing event, and time spent executing
+                summary = profile.summary()
+                timer.add("queue_wait", summary["queue_wait"])
+                timer.add("execution", summary["execution"])
+                node_profile = {
+                    "nodes": summary["nodes"],
+                    "class_types": summary["class_types"],
+                    "cached_nodes": summary["cached"],
+                }
+                self.node_timings.add(profile, label=number_of_images)
+                print(
+                    f"Node timing percentiles at {number_of_images} images: {self.node_timings.percentiles(number_of_images)}"
+                )
+            self.harvest_preprocess_cache(scratch)
+
+            with timer.stage("collect_outputs"):
+                print("Outputs:")
+                files = self.collect_outputs(prompt_id, outputs, scratch.output_dir)
+
+            if not disable_safety_checker:
+                with timer.stage("output_safety_check"):
+                    has_nsfw_content = self.check_safety(files)
+                if any(has_nsfw_content):
+                    print("Removing NSFW images")
+                    files = [f for i, f in enumerate(files) if not has_nsfw_content[i]]
+
+            status = "ok"
+            return files
+        finally:
+            self.reaper.release(scratch)
+            self.write_timing(
+                timer,
+                status=status,
+                mode="single",
+                number_of_images=number_of_images,
+                **node_profile,
+            )
+
     def predict(
         self,
         image: Path = Input(
@@ -171,65 +867,50 @@ class Predictor(BasePredictor):
         disable_safety_checker: bool = Input(
             description="Disable safety checker for generated images", default=False
         ),
-    ) -> List[Path]:
+        mode: str = Input(
+            default="single",
+            choices=["single", "stream", "batch", "pipelined"],
+            description="single returns the images once they are all done, stream returns each one as soon as it is saved. batch and pipelined convert image to image_to_become, then each of extra_images to the image at the same position in extra_images_to_become, pipelined overlapping the preparation of each pair with the generation of the one before",
+        ),
+        extra_images: List[Path] = Input(
+            default=None,
+            description="More images of people to convert, for batch and pipelined modes",
+        ),
+        extra_images_to_become: List[Path] = Input(
+            default=None,
+            description="What each of extra_images converts to, for batch and pipelined modes",
+        ),
+    ) -> Iterator[Path]:
         """Run a single prediction on the model"""
-        self.cleanup()
-
-        if image is None or image_to_become is None:
-            missing_images = []
-            if image is None:
-                missing_images.append("image")
-            if image_to_become is None:
-                missing_images.append("image_to_become")
-            raise ValueError(f"No {' and '.join(missing_images)} provided")
-
-        filename = self.handle_input_file(image, "image_of_face")
-        image_to_become_filename = self.handle_input_file(
-            image_to_become, "image_to_become"
-        )
-
-        input_files = [image, image_to_become]
-        if not disable_safety_checker:
-            has_nsfw_content_input = self.safetyChecker.run(input_files)
-            if any(has_nsfw_content_input):
-                raise ValueError("NSFW content detected in input images")
-
-        if seed is None:
-            seed = random.randint(0, 2**32 - 1)
-            print(f"Random seed set to: {seed}")
-
-        workflow = json.loads(workflow_json)
-        self.update_workflow(
-            workflow,
-            filename=filename,
-            image_to_become_filename=image_to_become_filename,
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            number_of_images=number_of_images,
-            prompt_strength=prompt_strength,
-            control_depth_strength=control_depth_strength,
-            instant_id_strength=instant_id_strength,
-            image_to_become_strength=image_to_become_strength,
-            image_to_become_noise=image_to_become_noise,
-            denoising_strength=denoising_strength,
-            seed=seed,
-        )
-
-        wf = self.comfyUI.load_workflow(workflow, check_weights=False)
-        self.comfyUI.connect()
-        self.comfyUI.run_workflow(wf)
-
-        files = []
-        output_directories = [OUTPUT_DIR]
-
-        for directory in output_directories:
-            print(f"Contents of {directory}:")
-            files.extend(self.log_and_collect_files(directory))
-
-        if not disable_safety_checker:
-            has_nsfw_content = self.safetyChecker.run(files)
-            if any(has_nsfw_content):
-                print("Removing NSFW images")
-                files = [f for i, f in enumerate(files) if not has_nsfw_content[i]]
-
-        return files
+        params = {
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "number_of_images": number_of_images,
+            "denoising_strength": denoising_strength,
+            "prompt_strength": prompt_strength,
+            "control_depth_strength": control_depth_strength,
+            "instant_id_strength": instant_id_strength,
+            "image_to_become_strength": image_to_become_strength,
+            "image_to_become_noise": image_to_become_noise,
+            "seed": seed,
+        }
+
+        if mode == "stream":
+            yield from self.predict_stream(
+                image, image_to_become, disable_safety_checker, **params
+            )
+        elif mode in ["batch", "pipelined"]:
+            pairs = self.batch_pairs(
+                image, image_to_become, extra_images, extra_images_to_become
+            )
+            run = self.predict_batch if mode == "batch" else self.predict_pipelined
+            for files in run(
+                pairs, disable_safety_checker=disable_safety_checker, **params
+            ):
+                for f in files:
+                    yield Path(f)
+        else:
+            for f in self.predict_single(
+                image, image_to_become, disable_safety_checker, **params
+            ):
+                yield Path(f)
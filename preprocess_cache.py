@@ -0,0 +1,125 @@
+import os
+import json
+import shutil
+import time
+import hashlib
+import threading
+
+PREPROCESS_CACHE = os.environ.get("PREPROCESS_CACHE_DIR", "./preprocess-cache")
+PREPROCESS_CACHE_MAX_BYTES = int(
+    os.environ.get("PREPROCESS_CACHE_MAX_BYTES", 2 * 1024**3)
+)
+STATS_FILE = "stats.json"
+# Seconds between writes of the hit and miss counts, they're kept in memory
+# in between
+STATS_FLUSH_INTERVAL = int(os.environ.get("PREPROCESS_CACHE_STATS_INTERVAL", 30))
+
+
+class PreprocessCache:
+    # Disk backed, content addressed store for per-image preprocessing
+    # artifacts. Entries are named by key, and their mtime doubles as the LRU
+    # clock so eviction order survives restarts.
+    def __init__(self, directory=PREPROCESS_CACHE, max_bytes=PREPROCESS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.stats = self._load_stats()
+        self.stats_dirty = False
+        self.flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flush_thread.start()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, kind, data, **params):
+        digest = hashlib.sha256(data)
+        digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        return f"{kind}-{digest.hexdigest()[:32]}"
+
+    def get(self, key, extension):
+        path = os.path.join(self.directory, key + extension)
+        hit = os.path.exists(path)
+        if hit:
+            os.utime(path)
+        self._record(key.split("-", 1)[0], hit)
+        return path if hit else None
+
+    def put(self, key, extension, source):
+        path = os.path.join(self.directory, key + extension)
+        staging = f"{path}.{threading.get_ident()}.tmp"
+        shutil.move(source, staging)
+        os.replace(staging, path)
+        self.evict()
+
+    def harvest(self, directory):
+        # Files saved by the workflow are named <key>_<counter>_.<ext>
+        if not os.path.isdir(directory):
+            return
+        for f in os.listdir(directory):
+            key, extension = os.path.splitext(f)
+            key = key.rsplit("_", 2)[0]
+            self.put(key, extension, os.path.join(directory, f))
+            print(f"Cached {key}{extension}")
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            total = 0
+            for f in os.listdir(self.directory):
+                if f == STATS_FILE or f.endswith(".tmp"):
+                    continue
+                stat = os.stat(os.path.join(self.directory, f))
+                entries.append((stat.st_mtime, stat.st_size, f))
+                total += stat.st_size
+
+            for _, size, f in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                os.remove(os.path.join(self.directory, f))
+                total -= size
+                print(f"Evicted {f} from preprocess cache")
+
+    def hit_rates(self):
+        with self.lock:
+            return {
+                kind: {
+                    **counts,
+                    "hit_rate": counts["hits"] / max(counts["hits"] + counts["misses"], 1),
+                }
+                for kind, counts in self.stats.items()
+            }
+
+    def _record(self, kind, hit):
+        with self.lock:
+            counts = self.stats.setdefault(kind, {"hits": 0, "misses": 0})
+            counts["hits" if hit else "misses"] += 1
+            self.stats_dirty = True
+
+    def flush_stats(self):
+        with self.lock:
+            if not self.stats_dirty:
+                return
+            stats = json.dumps(self.stats)
+            self.stats_dirty = False
+        # Written then renamed, so a crash mid write keeps the last counts
+        path = os.path.join(self.directory, STATS_FILE)
+        with open(f"{path}.tmp", "w") as f:
+            f.write(stats)
+        os.replace(f"{path}.tmp", path)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(STATS_FLUSH_INTERVAL)
+            try:
+                self.flush_stats()
+            except OSError as e:
+                print(f"Could not write preprocess cache stats: {e}")
+
+    def _load_stats(self):
+        try:
+            with open(os.path.join(self.directory, STATS_FILE), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
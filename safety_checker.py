@@ -26,15 +26,22 @@ class SafetyChecker:
         ).to("cuda")
         self.feature_extractor = CLIPImageProcessor.from_pretrained(FEATURE_EXTRACTOR)
 
-    def load_image(self, image_path):
-        return PIL.Image.open(image_path).convert("RGB")
-
-    def run(self, image_paths):
-        images = [self.load_image(image_path) for image_path in image_paths]
+    def load_image(self, image):
+        # Accepts already decoded images as well as paths
+        if isinstance(image, np.ndarray):
+            image = PIL.Image.fromarray(image)
+        elif not isinstance(image, PIL.Image.Image):
+            image = PIL.Image.open(image)
+        return image if image.mode == "RGB" else image.convert("RGB")
+
+    def run(self, images, raise_if_all_nsfw=True):
+        images = [self.load_image(image) for image in images]
         safety_checker_input = self.feature_extractor(images, return_tensors="pt").to(
             "cuda"
         )
-        np_images = [np.array(val) for val in images]
+        # The checker only blanks out flagged entries in these, so placeholders
+        # save copying every full size image into a new array
+        np_images = [np.zeros((1, 1, 3), dtype=np.uint8) for _ in images]
         _, is_nsfw = self.safety_checker(
             images=np_images,
             clip_input=safety_checker_input.pixel_values.to(torch.float16),
@@ -44,7 +51,7 @@ class SafetyChecker:
             if nsfw:
                 print(f"NSFW content detected in image {i}")
 
-        if all(is_nsfw):
+        if raise_if_all_nsfw and all(is_nsfw):
             raise Exception(
                 "NSFW content detected in all outputs. Try running it again, or try a different prompt."
             )
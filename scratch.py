@@ -0,0 +1,94 @@
+import os
+import time
+import uuid
+import shutil
+import threading
+from collections import Counter
+
+# Outputs are handed back as paths, so they have to outlive the prediction
+# long enough to be uploaded
+SCRATCH_REAP_AFTER = float(os.environ.get("SCRATCH_REAP_AFTER", 600))
+SCRATCH_REAP_INTERVAL = 30
+
+
+class Scratch:
+    # Request scoped output subdirectory, so concurrent predictions never
+    # share filenames, plus the shared inputs the request has pinned
+    def __init__(self, output_root):
+        self.id = uuid.uuid4().hex
+        self.output_dir = os.path.join(output_root, self.id)
+        self.inputs = []
+        os.makedirs(self.output_dir)
+
+    def name(self, filename):
+        # How ComfyUI refers to a file in this request's subdirectory
+        return f"{self.id}/{filename}"
+
+
+class ScratchReaper:
+    # Deletes finished request directories on a background thread, keeping
+    # directory removal off the prediction latency path
+    def __init__(self, sweep_directories=(), reap_after=SCRATCH_REAP_AFTER):
+        self.sweep_directories = sweep_directories
+        self.reap_after = reap_after
+        self.pending = []
+        # Swept files still needed by a request, however old they are
+        self.pinned = Counter()
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def pin(self, scratch, path):
+        with self.condition:
+            self.pinned[path] += 1
+        scratch.inputs.append(path)
+
+    def release(self, scratch):
+        # Pinned inputs become sweepable from now, outputs go once they have
+        # been uploaded
+        now = time.time()
+        with self.condition:
+            for path in scratch.inputs:
+                self.pinned[path] -= 1
+                if self.pinned[path] <= 0:
+                    del self.pinned[path]
+                    try:
+                        os.utime(path)
+                    except FileNotFoundError:
+                        pass
+            scratch.inputs = []
+            self.pending.append((now + self.reap_after, scratch.output_dir))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait(SCRATCH_REAP_INTERVAL)
+                now = time.time()
+                due = [d for when, d in self.pending if when <= now]
+                self.pending = [(when, d) for when, d in self.pending if when > now]
+
+            for directory in due:
+                shutil.rmtree(directory, ignore_errors=True)
+            for directory in self.sweep_directories:
+                self.sweep(directory, now - self.reap_after)
+
+    def sweep(self, directory, cutoff):
+        # Shared directories, like ComfyUI's temp, only lose stale entries
+        if not os.path.isdir(directory):
+            return
+        for f in os.listdir(directory):
+            path = os.path.join(directory, f)
+            # Under the lock, so nothing is pinned between the check and the
+            # removal
+            with self.condition:
+                if path in self.pinned:
+                    continue
+                try:
+                    if os.path.getmtime(path) >= cutoff:
+                        continue
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,71 @@
+import sys
+import os
+import io
+import time
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from PIL import Image
+from input_files import read_input_file, EXIF_ORIENTATION
+
+# Roughly a 12 MP phone photo
+SIZE = (4032, 3024)
+RUNS = 5
+
+
+def legacy_read_input_file(input_file):
+    # Previous behaviour: always decode, rotate and re-encode JPEGs as PNG
+    image = Image.open(input_file)
+    orientation = image.getexif().get(EXIF_ORIENTATION)
+    if orientation == 3:
+        image = image.rotate(180, expand=True)
+    elif orientation == 6:
+        image = image.rotate(270, expand=True)
+    elif orientation == 8:
+        image = image.rotate(90, expand=True)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def make_samples(directory):
+    image = Image.effect_noise(SIZE, 64).convert("RGB")
+    samples = {}
+
+    samples["jpeg"] = os.path.join(directory, "upright.jpg")
+    image.save(samples["jpeg"], quality=90)
+
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION] = 6
+    samples["jpeg (rotated)"] = os.path.join(directory, "rotated.jpg")
+    image.save(samples["jpeg (rotated)"], quality=90, exif=exif)
+
+    samples["png"] = os.path.join(directory, "image.png")
+    image.save(samples["png"])
+
+    samples["webp"] = os.path.join(directory, "image.webp")
+    image.save(samples["webp"], quality=90)
+    return samples
+
+
+def time_function(function, path):
+    start = time.time()
+    for _ in range(RUNS):
+        function(path)
+    return (time.time() - start) / RUNS * 1000
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        samples = make_samples(directory)
+        print(f"{'format':<16}{'current':>12}{'legacy':>12}")
+        for name, path in samples.items():
+            current = time_function(read_input_file, path)
+            if name.startswith("jpeg"):
+                legacy = f"{time_function(legacy_read_input_file, path):.1f}ms"
+            else:
+                legacy = "copy"
+            print(f"{name:<16}{current:>10.1f}ms{legacy:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import sys
+import os
+import time
+import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from helpers.comfyui_pool import ComfyUIPool, DRAIN_BACKOFF
+
+# Runs prompts through a ComfyUIPool backed by stub servers, one of which is
+# slower, and kills another halfway through to check it is drained and then
+# re-admitted once it is back
+PORTS = [8290, 8291, 8292]
+NODE_TIMES = [0.02, 0.02, 0.08]
+PROMPTS = 60
+CONCURRENCY = 6
+STUB = os.path.join(os.path.dirname(__file__), "stub_comfyui_server.py")
+
+WORKFLOW = {
+    "1": {"class_type": "KSampler", "inputs": {}},
+    "2": {"class_type": "VAEDecode", "inputs": {}},
+    "3": {"class_type": "SaveImage", "inputs": {"filename_prefix": "pool/ComfyUI"}},
+}
+
+
+def start_stub(port, node_time):
+    return subprocess.Popen(
+        [sys.executable, STUB, "--port", str(port), "--node-time", str(node_time)]
+    )
+
+
+def run_prompts(pool, count):
+    def run(_):
+        prompt_id = pool.queue_prompt(WORKFLOW)
+        server = pool.server_for(prompt_id)
+        pool.wait_for_prompt_completion(WORKFLOW, prompt_id)
+        return server.server_address
+
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        return Counter(executor.map(run, range(count)))
+
+
+def main():
+    stubs = [start_stub(p, t) for p, t in zip(PORTS, NODE_TIMES)]
+    try:
+        pool = ComfyUIPool([f"127.0.0.1:{port}" for port in PORTS])
+        while not all(s.is_server_running() for s in pool.servers):
+            time.sleep(0.1)
+        pool.connect()
+
+        start = time.time()
+        print(f"All healthy: {dict(run_prompts(pool, PROMPTS))}")
+
+        stubs[0].kill()
+        stubs[0].wait()
+        print(f"One killed: {dict(run_prompts(pool, PROMPTS))}")
+
+        stubs[0] = start_stub(PORTS[0], NODE_TIMES[0])
+        # Past the first backoff, so the next routing pass probes it again
+        time.sleep(DRAIN_BACKOFF + 1)
+        print(f"Restarted: {dict(run_prompts(pool, PROMPTS))}")
+        print(f"Total: {time.time() - start:.2f}s")
+    finally:
+        for stub in stubs:
+            stub.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import sys
+import os
+import io
+import time
+import hashlib
+import tarfile
+import tempfile
+import threading
+from collections import Counter
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+os.environ.setdefault("WEIGHTS_BANDWIDTH_MBPS", "200")
+os.environ.setdefault("WEIGHTS_DOWNLOAD_WORKERS", "3")
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import weights_downloader
+from weights_downloader import WeightsDownloader
+
+# Serves weight tars from a local HTTP server and fetches them through the
+# downloader: once to see ordering and the bandwidth cap, then from two
+# callers at once to check shared weights are only transferred once, then
+# with the connection dropped halfway to check it resumes and verifies
+SIZES_MB = {
+    "checkpoint.safetensors": 64,
+    "controlnet.safetensors": 32,
+    "ipadapter.bin": 16,
+    "clip_vision.safetensors": 8,
+    "antelopev2": 2,
+    "midas.pt": 1,
+}
+
+
+class LocalManifest:
+    def __init__(self, base_url, dest, served):
+        self.weights_map = {
+            weight: {"url": f"{base_url}/{weight}.tar", "dest": dest}
+            for weight in SIZES_MB
+        }
+        self.checksums = {}
+        for weight in SIZES_MB:
+            with open(os.path.join(served, f"{weight}.tar"), "rb") as f:
+                data = f.read()
+            self.checksums[weight] = {
+                "size": len(data),
+                "sha256": hashlib.sha256(data).hexdigest(),
+            }
+
+    def checksum(self, weight):
+        return self.checksums[weight]
+
+    def is_non_commercial_only(self, weight):
+        return False
+
+
+def make_tars(directory):
+    for weight, size in SIZES_MB.items():
+        data = os.urandom(size * 1024 * 1024)
+        with tarfile.open(os.path.join(directory, f"{weight}.tar"), "w") as tar:
+            info = tarfile.TarInfo(weight)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def serve(directory, requests, drop_once):
+    class Handler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            requests[self.path] += 1
+            if self.path in drop_once:
+                # Announce the whole tar, send half and hang up
+                drop_once.discard(self.path)
+                with open(self.translate_path(self.path), "rb") as f:
+                    data = f.read()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data[: len(data) // 2])
+                self.close_connection = True
+                return
+            if "Range" not in self.headers:
+                return super().do_GET()
+            # Just the "bytes=<start>-" form the downloader sends
+            with open(self.translate_path(self.path), "rb") as f:
+                data = f.read()
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            if start >= len(data):
+                return self.send_error(416)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+            self.send_header("Content-Length", str(len(data) - start))
+            self.end_headers()
+            self.wfile.write(data[start:])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(Handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    with tempfile.TemporaryDirectory() as served, tempfile.TemporaryDirectory() as dest:
+        make_tars(served)
+        requests = Counter()
+        drop_once = set()
+        server = serve(served, requests, drop_once)
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+        downloader = WeightsDownloader(LocalManifest(base_url, dest, served))
+        start = time.time()
+        downloader.download_all(list(SIZES_MB))
+        total_mb = sum(SIZES_MB.values())
+        elapsed = time.time() - start
+        print(f"{total_mb}MB in {elapsed:.2f}s, {total_mb / elapsed:.1f}MB/s")
+
+        for weight in SIZES_MB:
+            os.remove(os.path.join(dest, weight))
+        requests.clear()
+        callers = [
+            threading.Thread(target=downloader.download_all, args=(list(SIZES_MB),)),
+            threading.Thread(target=downloader.download_all, args=(list(SIZES_MB)[:3],)),
+        ]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join()
+        duplicates = {path: n for path, n in requests.items() if n > 1}
+        print(f"GETs from two concurrent callers: {sum(requests.values())}, duplicated: {duplicates}")
+
+        weight = "checkpoint.safetensors"
+        os.remove(os.path.join(dest, weight))
+        drop_once.add(f"/{weight}.tar")
+        downloader.download_all([weight])
+        with open(os.path.join(dest, f"{weight}.sha256")) as f:
+            print(f"Resumed and verified: {f.read()}")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import json
+import uuid
+from aiohttp import web
+
+# Just enough of the ComfyUI server API to exercise the clients without a GPU:
+# prompts run one at a time, each node takes --node-time seconds and every
+# SaveImage node reports one image.
+
+PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082"
+)
+
+
+class StubServer:
+    def __init__(self, node_time):
+        self.node_time = node_time
+        self.pending = []
+        self.running = None
+        self.history = {}
+        self.sockets = {}
+        self.interrupted = False
+        self.wake = asyncio.Event()
+
+    async def send(self, client_id, message_type, data):
+        ws = self.sockets.get(client_id)
+        if ws is not None and not ws.closed:
+            await ws.send_str(json.dumps({"type": message_type, "data": data}))
+
+    async def worker(self):
+        while True:
+            while not self.pending:
+                self.wake.clear()
+                await self.wake.wait()
+            self.running = self.pending.pop(0)
+            number, prompt_id, prompt, client_id = self.running
+            self.interrupted = False
+            outputs = {}
+            await self.send(client_id, "execution_start", {"prompt_id": prompt_id})
+            for node_id, node in prompt.items():
+                if self.interrupted:
+                    break
+                await self.send(
+                    client_id, "executing", {"node": node_id, "prompt_id": prompt_id}
+                )
+                await asyncio.sleep(self.node_time)
+                if node.get("class_type") == "SaveImage":
+                    prefix = node.get("inputs", {}).get("filename_prefix", "ComfyUI")
+                    subfolder, _, name = prefix.rpartition("/")
+                    image = {
+                        "filename": f"{name}_{prompt_id[:8]}_00001_.png",
+                        "subfolder": subfolder,
+                        "type": "output",
+                    }
+                    outputs[node_id] = {"images": [image]}
+                    await self.send(
+                        client_id,
+                        "executed",
+                        {"node": node_id, "output": outputs[node_id], "prompt_id": prompt_id},
+                    )
+            self.history[prompt_id] = {"prompt": self.running[:3], "outputs": outputs}
+            self.running = None
+            await self.send(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query.get("clientId", uuid.uuid4().hex)
+        self.sockets[client_id] = ws
+        await ws.send_str(json.dumps({"type": "status", "data": {"sid": client_id}}))
+        async for _ in ws:
+            pass
+        return ws
+
+    async def post_prompt(self, request):
+        body = await request.json()
+        prompt_id = str(uuid.uuid4())
+        number = len(self.history) + len(self.pending)
+        self.pending.append((number, prompt_id, body["prompt"], body.get("client_id")))
+        self.wake.set()
+        return web.json_response({"prompt_id": prompt_id, "number": number})
+
+    async def get_queue(self, request):
+        return web.json_response(
+            {
+                "queue_running": [list(self.running[:3])] if self.running else [],
+                "queue_pending": [list(p[:3]) for p in self.pending],
+            }
+        )
+
+    async def post_queue(self, request):
+        body = await request.json()
+        if body.get("clear"):
+            self.pending = []
+        delete = body.get("delete", [])
+        self.pending = [p for p in self.pending if p[1] not in delete]
+        return web.Response()
+
+    async def interrupt(self, request):
+        self.interrupted = True
+        return web.Response()
+
+    async def get_history(self, request):
+        prompt_id = request.match_info["prompt_id"]
+        if prompt_id not in self.history:
+            return web.json_response({})
+        return web.json_response({prompt_id: self.history[prompt_id]})
+
+    async def upload_image(self, request):
+        form = await request.post()
+        image = form["image"]
+        return web.json_response(
+            {"name": image.filename, "subfolder": form.get("subfolder", ""), "type": "input"}
+        )
+
+    async def view(self, request):
+        return web.Response(body=PNG, content_type="image/png")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--node-time", type=float, default=0.05)
+    args = parser.parse_args()
+
+    server = StubServer(args.node_time)
+
+    async def start_worker(app):
+        app["worker"] = asyncio.ensure_future(server.worker())
+
+    app = web.Application(client_max_size=64 * 1024**2)
+    app.on_startup.append(start_worker)
+    app.router.add_get("/ws", server.websocket)
+    app.router.add_post("/prompt", server.post_prompt)
+    app.router.add_get("/queue", server.get_queue)
+    app.router.add_post("/queue", server.post_queue)
+    app.router.add_post("/interrupt", server.interrupt)
+    app.router.add_get("/history/{prompt_id}", server.get_history)
+    app.router.add_post("/upload/image", server.upload_image)
+    app.router.add_get("/view", server.view)
+    print(f"Stub ComfyUI server on port {args.port}", flush=True)
+    web.run_app(app, host="127.0.0.1", port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
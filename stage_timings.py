@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+STAGE_TIMINGS_JSONL = os.environ.get(
+    "STAGE_TIMINGS_JSONL", "/tmp/metrics/stage_timings.jsonl"
+)
+STAGE_TIMINGS_PROM = os.environ.get(
+    "STAGE_TIMINGS_PROM", "/tmp/metrics/stage_timings.prom"
+)
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+class StageTimer:
+    # Wall time per stage of a single prediction
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.started = time.time()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        if seconds is not None:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def record(self, **extra):
+        self.stages["total"] = time.time() - self.started
+        return {
+            "request_id": self.request_id,
+            "started": self.started,
+            **extra,
+            "stages": {name: round(value, 6) for name, value in self.stages.items()},
+        }
+
+
+class SetupSteps:
+    # Runs each setup step on its own thread as soon as the steps it depends
+    # on have finished, and works out which chain of steps set the total
+    def __init__(self):
+        self.started = time.time()
+        self.executor = ThreadPoolExecutor(max_workers=8)
+        self.futures = {}
+        self.dependencies = {}
+        self.spans = {}
+        self.background = set()
+
+    def add(self, name, fn, after=(), background=False):
+        # Background steps aren't waited for, their future is returned for
+        # whoever needs the result later
+        self.dependencies[name] = list(after)
+        if background:
+            self.background.add(name)
+        dependencies = [self.futures[d] for d in after]
+
+        def run():
+            for dependency in dependencies:
+                dependency.result()
+            start = time.time()
+            try:
+                return fn()
+            finally:
+                end = time.time()
+                self.spans[name] = (start - self.started, end - self.started)
+                print(f"Setup step {name} took {end - start:.2f}s")
+
+        self.futures[name] = self.executor.submit(run)
+        return self.futures[name]
+
+    def wait(self):
+        for name, future in self.futures.items():
+            if name not in self.background:
+                future.result()
+        self.executor.shutdown(wait=False)
+
+    def critical_path(self):
+        # Back from the last step to finish, through whichever dependency
+        # finished last each time
+        awaited = [n for n in self.spans if n not in self.background]
+        name = max(awaited, key=lambda n: self.spans[n][1])
+        path = [name]
+        while self.dependencies[name]:
+            name = max(self.dependencies[name], key=lambda n: self.spans[n][1])
+            path.append(name)
+        return path[::-1]
+
+    def record(self):
+        awaited = {n: s for n, s in self.spans.items() if n not in self.background}
+        stages = {f"setup_{n}": round(end - start, 6) for n, (start, end) in awaited.items()}
+        stages["setup_total"] = round(max(end for _, end in awaited.values()), 6)
+        return {
+            "request_id": "setup",
+            "started": self.started,
+            "event": "setup",
+            "critical_path": self.critical_path(),
+            "stages": stages,
+        }
+
+
+class TimingSink:
+    # Appends every record to a JSONL file and keeps a Prometheus text
+    # exposition file of per stage histograms up to date, so dashboards can
+    # scrape it with the node exporter textfile collector
+    def __init__(self, jsonl_path=STAGE_TIMINGS_JSONL, prom_path=STAGE_TIMINGS_PROM):
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.histograms = {}
+        self.lock = threading.Lock()
+        for path in [jsonl_path, prom_path]:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def write(self, record):
+        with self.lock:
+            with open(self.jsonl_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+            for stage, seconds in record["stages"].items():
+                histogram = self.histograms.setdefault(
+                    stage, {"buckets": [0] * len(BUCKETS), "sum": 0, "count": 0}
+                )
+                for i, bound in enumerate(BUCKETS):
+                    if seconds <= bound:
+                        histogram["buckets"][i] += 1
+                histogram["sum"] += seconds
+                histogram["count"] += 1
+
+            self.write_prometheus()
+
+    def write_prometheus(self):
+        lines = [
+            "# HELP become_image_stage_seconds Wall time spent in each prediction stage",
+            "# TYPE become_image_stage_seconds histogram",
+        ]
+        for stage, histogram in sorted(self.histograms.items()):
+            for bound, count in zip(BUCKETS, histogram["buckets"]):
+                lines.append(
+                    f'become_image_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}'
+                )
+            lines.append(
+                f'become_image_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}'
+            )
+            lines.append(
+                f'become_image_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]:.6f}'
+            )
+            lines.append(
+                f'become_image_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}'
+            )
+
+        # Written then renamed, so a scrape never sees a partial file
+        staging = f"{self.prom_path}.tmp"
+        with open(staging, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(staging, self.prom_path)
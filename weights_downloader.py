@@ -1,17 +1,140 @@
 import subprocess
 import time
 import os
+import json
+import shutil
+import hashlib
+import tarfile
+import threading
+import http.client
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from weights_manifest import WeightsManifest
 
 BASE_URL = "https://weights.replicate.delivery/default/comfy-ui"
 BASE_PATH = "ComfyUI/models"
 
+# Transfers running at once, shared by every caller of a downloader
+WEIGHTS_DOWNLOAD_WORKERS = int(os.environ.get("WEIGHTS_DOWNLOAD_WORKERS", 8))
+
+# Total download rate cap in MB/s across all transfers, 0 for none. Only the
+# built in downloader can honour it, so setting it bypasses pget.
+WEIGHTS_BANDWIDTH_MBPS = float(os.environ.get("WEIGHTS_BANDWIDTH_MBPS", 0))
+
+# pget's parallel transfer, at the cost of verification: the tar never passes
+# through us, so neither its length nor its hash is checked
+USE_PGET = (
+    os.environ.get("WEIGHTS_USE_PGET") == "1"
+    and shutil.which("pget") is not None
+    and not WEIGHTS_BANDWIDTH_MBPS
+)
+
+# Tars are extracted into this folder of each weight's destination as they
+# download, so renaming them into place never crosses filesystems
+STAGING_DIR = ".staging"
+STREAM_CHUNK = 1024 * 1024
+
+# Times a dropped transfer is resumed before the attempt fails
+STREAM_RESUMES = 3
+
+
+class BandwidthLimit:
+    # Token bucket shared by every transfer, in bytes per second
+    def __init__(self, rate):
+        self.rate = rate
+        # A short burst, so the cap holds over seconds rather than on average
+        self.burst = rate / 10
+        self.allowance = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.allowance = min(
+                self.burst, self.allowance + (now - self.last) * self.rate
+            )
+            self.last = now
+            self.allowance -= size
+            delay = -self.allowance / self.rate if self.allowance < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class TarStream:
+    # A weight's tar read straight off HTTP for streaming extraction, hashed
+    # and counted on the way. A dropped transfer resumes with a range
+    # request, If-Range making sure the rest comes from the same file.
+    def __init__(self, url, limit, resumes=STREAM_RESUMES):
+        self.url = url
+        self.limit = limit
+        self.resumes = resumes
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.length = None
+        self.validator = None
+        self.response = self.open()
+
+    def open(self):
+        request = urllib.request.Request(self.url)
+        if self.size:
+            request.add_header("Range", f"bytes={self.size}-")
+            if self.validator:
+                request.add_header("If-Range", self.validator)
+        response = urllib.request.urlopen(request, timeout=60)
+        if not self.size:
+            length = response.headers.get("Content-Length")
+            self.length = int(length) if length is not None else None
+            self.validator = response.headers.get("ETag") or response.headers.get(
+                "Last-Modified"
+            )
+        elif response.status != 206:
+            response.close()
+            raise IOError(f"{self.url} changed while resuming, starting over")
+        else:
+            print(f"Resuming {self.url} from {self.size / (1024 * 1024):.2f}MB")
+        return response
+
+    def read(self, size=STREAM_CHUNK):
+        if size is None or size < 0:
+            size = STREAM_CHUNK
+        drops = 0
+        while True:
+            try:
+                data = self.response.read(min(size, STREAM_CHUNK))
+            except (OSError, http.client.HTTPException) as e:
+                error = e
+            else:
+                if data or self.length is None or self.size >= self.length:
+                    break
+                error = "connection closed early"
+            self.response.close()
+            drops += 1
+            if drops > self.resumes:
+                raise IOError(f"Transfer of {self.url} failed: {error}")
+            print(f"Transfer of {self.url} dropped ({error}), resuming")
+            self.response = self.open()
+
+        self.limit.consume(len(data))
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def close(self):
+        self.response.close()
+
 
 class WeightsDownloader:
-    def __init__(self):
-        self.weights_manifest = WeightsManifest()
+    def __init__(self, weights_manifest=None):
+        self.weights_manifest = weights_manifest or WeightsManifest()
         self.weights_map = self.weights_manifest.weights_map
+        self.bandwidth = BandwidthLimit(WEIGHTS_BANDWIDTH_MBPS * 1024 * 1024)
+        self.executor = ThreadPoolExecutor(max_workers=WEIGHTS_DOWNLOAD_WORKERS)
+        self.in_flight = {}
+        self.lock = threading.RLock()
 
     def download_weights(self, weight_str):
         if weight_str in self.weights_map:
@@ -19,7 +142,7 @@ class WeightsDownloader:
                 print(
                     f"⚠️  {weight_str} is for non-commercial use only. Unless you have obtained a commercial license.\nDetails: https://github.com/fofr/cog-comfyui/blob/main/weights_licenses.md"
                 )
-            self.download_if_not_exists(
+            return self.download_if_not_exists(
                 weight_str,
                 self.weights_map[weight_str]["url"],
                 self.weights_map[weight_str]["dest"],
@@ -41,8 +164,89 @@ class WeightsDownloader:
         )
 
     def download_if_not_exists(self, weight_str, url, dest):
-        if not os.path.exists(f"{dest}/{weight_str}"):
+        if not self.is_installed(f"{dest}/{weight_str}"):
             self.download(weight_str, url, dest)
+            return True
+        return False
+
+    def is_installed(self, path):
+        # Weights are renamed into place once complete, so one that exists is
+        # whole. Its sidecar, when there is one, also catches later damage
+        # with a stat instead of a hash.
+        if not os.path.exists(path):
+            return False
+        sidecar = read_sidecar(f"{path}.sha256")
+        if sidecar is not None and sidecar["size"] != installed_size(path):
+            print(f"⚠️  {path} doesn't match its recorded size, reinstalling")
+            return False
+        return True
+
+    def download_all(self, weights):
+        # Fetches every weight concurrently, returning {weight: (seconds,
+        # downloaded)}. Largest go first, so the longest transfer isn't left
+        # to run alone at the end. Unknown weights still raise, once the rest
+        # are done.
+        start = time.time()
+        sizes = self.remote_sizes([w for w in weights if not self.is_present(w)])
+        order = sorted(weights, key=lambda w: -sizes.get(w, 0))
+        futures = {weight: self.submit(weight) for weight in order}
+        wait(futures.values())
+        report = {weight: future.result() for weight, future in futures.items()}
+        self.print_report(report, time.time() - start)
+        return report
+
+    def submit(self, weight):
+        # Concurrent callers asking for the same weight share one transfer
+        with self.lock:
+            future = self.in_flight.get(weight)
+            if future is None:
+                future = self.executor.submit(self.timed_download, weight)
+                self.in_flight[weight] = future
+                future.add_done_callback(lambda _: self.forget(weight))
+            return future
+
+    def forget(self, weight):
+        with self.lock:
+            self.in_flight.pop(weight, None)
+
+    def timed_download(self, weight):
+        start = time.time()
+        downloaded = self.download_weights(weight)
+        return time.time() - start, downloaded
+
+    def is_present(self, weight):
+        entry = self.weights_map.get(weight)
+        return entry is not None and self.is_installed(f"{entry['dest']}/{weight}")
+
+    def remote_sizes(self, weights):
+        # Content-Length of each weight's tar, 0 when unknown
+        def size(weight):
+            if weight not in self.weights_map:
+                return 0
+            request = urllib.request.Request(
+                self.weights_map[weight]["url"], method="HEAD"
+            )
+            try:
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    return int(response.headers.get("Content-Length") or 0)
+            except (OSError, ValueError):
+                return 0
+
+        if not weights:
+            return {}
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            return dict(zip(weights, pool.map(size, weights)))
+
+    def print_report(self, report, elapsed):
+        downloaded = [w for w, (_, d) in report.items() if d]
+        print(
+            f"Weights: {len(report)} needed, {len(downloaded)} downloaded in {elapsed:.2f}s"
+        )
+        for weight, (seconds, was_downloaded) in sorted(
+            report.items(), key=lambda item: -item[1][0]
+        ):
+            status = "downloaded" if was_downloaded else "present"
+            print(f"{'⌛️' if was_downloaded else '✅'} {weight}: {seconds:.2f}s ({status})")
 
     def download(self, weight_str, url, dest):
         if "/" in weight_str:
@@ -52,9 +256,7 @@ class WeightsDownloader:
 
         print(f"⏳ Downloading {weight_str} to {dest}")
         start = time.time()
-        subprocess.check_call(
-            ["pget", "--log-level", "warn", "-xf", url, dest], close_fds=False
-        )
+        self.install(weight_str, url, dest)
         elapsed_time = time.time() - start
         downloaded_file_path = os.path.join(dest, os.path.basename(weight_str))
 
@@ -67,6 +269,85 @@ class WeightsDownloader:
         except FileNotFoundError:
             print(f"⌛️ Completed in {elapsed_time:.2f}s but file not found.")
 
+    def install(self, weight_str, url, dest):
+        # Extracted into staging as the tar streams in, nothing lands in dest
+        # until the whole tar has been verified
+        staged = os.path.join(dest, STAGING_DIR, weight_str.replace("/", "__"))
+        extracted = f"{staged}.extract"
+        expected = self.weights_manifest.checksum(weight_str)
+
+        for _ in range(2):
+            shutil.rmtree(extracted, ignore_errors=True)
+            os.makedirs(extracted)
+            if USE_PGET:
+                subprocess.check_call(
+                    ["pget", "--log-level", "warn", "-xf", url, extracted],
+                    close_fds=False,
+                )
+                record = {}
+                break
+            try:
+                record = self.stream_tar(url, extracted)
+            except (OSError, tarfile.TarError) as e:
+                print(f"❌ {weight_str} transfer failed: {e}")
+                continue
+            if self.verify(weight_str, record, expected):
+                break
+        else:
+            shutil.rmtree(extracted, ignore_errors=True)
+            raise ValueError(f"{weight_str} failed verification twice")
+
+        os.makedirs(dest, exist_ok=True)
+        for name in os.listdir(extracted):
+            target = os.path.join(dest, name)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            os.replace(os.path.join(extracted, name), target)
+
+        path = os.path.join(dest, os.path.basename(weight_str))
+        if os.path.exists(path):
+            write_sidecar(f"{path}.sha256", {**record, "size": installed_size(path)})
+        shutil.rmtree(extracted, ignore_errors=True)
+
+    def stream_tar(self, url, directory):
+        # Returns what the transfer told us about the tar, for verify and the
+        # sidecar
+        stream = TarStream(url, self.bandwidth)
+        try:
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                if hasattr(tarfile, "data_filter"):
+                    tar.extractall(directory, filter="data")
+                else:
+                    tar.extractall(directory)
+            # The padding after the last member is part of the hash too
+            while stream.read():
+                pass
+        finally:
+            stream.close()
+        return {
+            "tar_sha256": stream.sha256.hexdigest(),
+            "tar_size": stream.size,
+            "content_length": stream.length,
+            "etag": stream.validator,
+        }
+
+    def verify(self, weight_str, record, expected):
+        # Against the manifest's size and hash when it has them, and always
+        # against the length the server announced
+        size, digest = record["tar_size"], record["tar_sha256"]
+        if record["content_length"] not in (None, size):
+            print(f"❌ {weight_str} is {size} bytes, the server sent {record['content_length']}")
+            return False
+        if expected and expected.get("size") not in (None, size):
+            print(f"❌ {weight_str} is {size} bytes, expected {expected['size']}")
+            return False
+        if expected and expected.get("sha256") not in (None, digest):
+            print(f"❌ {weight_str} sha256 {digest} doesn't match the manifest")
+            return False
+        if not expected:
+            print(f"No checksum for {weight_str} in the manifest, got sha256 {digest}")
+        return True
+
     def download_custom_lora(self, uuid, url, dest):
         if not os.path.exists(f"{dest}/{uuid}"):
             dest_with_uuid = os.path.join(dest, uuid)
@@ -112,3 +393,28 @@ class WeightsDownloader:
             if os.path.exists(file_path):
                 os.remove(file_path)
                 print(f"🗑️ Removed {file_path}")
+
+
+def read_sidecar(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_sidecar(path, data):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def installed_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+        if not name.endswith(".sha256")
+    )
@@ -57,7 +57,9 @@ class WeightsManifest:
             updated_manifest = json.load(f)
 
         for key in updated_manifest:
-            if key in original_manifest:
+            if key in original_manifest and isinstance(original_manifest[key], dict):
+                original_manifest[key].update(updated_manifest[key])
+            elif key in original_manifest:
                 for item in updated_manifest[key]:
                     if item not in original_manifest[key]:
                         print(f"Adding {item} to {key}")
@@ -109,5 +111,10 @@ class WeightsManifest:
             "RMBG-1.4/model.pth",
         ]
 
+    def checksum(self, weight_str):
+        # {"size": bytes, "sha256": hex} of the weight's tar, from the
+        # lowercase "checksums" key the weights map skips
+        return self.weights_manifest.get("checksums", {}).get(weight_str)
+
     def is_non_commercial_only(self, weight_str):
         return weight_str in self.non_commercial_weights()